@@ -0,0 +1,204 @@
+"""Admission control in front of the WSGI application.
+
+Each request falls into a route class by its method and path. A class runs
+at most `limit` requests at once, and all classes together at most
+max_active. A request that cannot start waits in its class's queue, which
+holds at most `queue` requests, for up to wait_secs. When the queue is full
+or the wait runs out, the request gets an immediate 503 with Retry-After,
+and no handler runs for it.
+
+A freed slot goes to the waiting request with the lowest priority number,
+and ties go to the one that came first. So uploads get in before page
+refreshes when the server is saturated. Limits apply per process.
+"""
+
+import bisect
+from collections import Counter, namedtuple
+import itertools
+import threading
+import time
+
+import metrics
+import profiling
+
+
+RouteClass = namedtuple(
+        'RouteClass', ['priority', 'limit', 'queue', 'wait_secs',
+                       'retry_after'])
+
+DEFAULT_CLASSES = {
+    'upload': RouteClass(0, 16, 200, 30.0, 5),
+    'grader': RouteClass(1, 8, 50, 10.0, 2),
+    'candidate': RouteClass(2, 24, 100, 5.0, 3),
+    'files': RouteClass(2, 16, 100, 5.0, 3),
+    'admin': RouteClass(3, 4, 20, 30.0, 10),
+}
+
+# (method or None for any, path prefix, class or None for unlimited); the
+# first match wins and unmatched requests are not limited either
+DEFAULT_ROUTES = [
+    ('GET', '/supersecreteurl/stats', None),
+    ('POST', '/upload_solution/', 'upload'),
+    (None, '/user/', 'candidate'),
+    (None, '/api/grading/', 'grader'),
+    (None, '/submission', 'grader'),
+    (None, '/supersecreteurl/', 'admin'),
+    (None, '/save_resolve/', 'admin'),
+    (None, '/exam/', 'admin'),
+    (None, '/static/', 'files'),
+]
+
+BUSY_TEXT = 'The server is busy, please try again in {0} seconds.'
+# Pages reload themselves, so a candidate is not left on the error.
+BUSY_PAGE = ('<!DOCTYPE html><html><head><meta charset="utf-8">'
+             '<meta http-equiv="refresh" content="{0}"></head>'
+             '<body><p>' + BUSY_TEXT + '</p></body></html>')
+
+
+class _Waiter(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.event = threading.Event()
+        self.admitted = False
+
+
+class AdmissionController(object):
+
+    def __init__(self, classes=DEFAULT_CLASSES, routes=DEFAULT_ROUTES,
+                 max_active=32, window_secs=300, clock=time.monotonic):
+        self._classes = dict(classes)
+        self._routes = list(routes)
+        self._max_active = max_active
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._arrivals = itertools.count()
+        self._waiting = []  # (priority, arrival, _Waiter), sorted
+        self._total = 0
+        self._active = Counter()
+        self._queued = Counter()
+        self._peak_queued = Counter()
+        self.admitted = Counter()
+        self.rejected = Counter()
+        self.timed_out = Counter()
+        self._waits = {name: metrics.RollingHistogram(window_secs)
+                       for name in self._classes}
+
+    def classify(self, environ):
+        """Route class of a request, or None if it is not limited."""
+        method = environ.get('REQUEST_METHOD', 'GET')
+        path = environ.get('PATH_INFO', '')
+        for route_method, prefix, name in self._routes:
+            if route_method in (None, method) and path.startswith(prefix):
+                return name
+        return None
+
+    def _start(self, name):
+        self._total += 1
+        self._active[name] += 1
+        self.admitted[name] += 1
+
+    def acquire(self, name):
+        """Take a slot of class name; False if the request is rejected."""
+        route_class = self._classes[name]
+        with self._lock:
+            # Anyone already waiting is blocked by a limit this request
+            # shares or by the total, so it cannot jump the queue this way.
+            if (self._total < self._max_active
+                    and self._active[name] < route_class.limit):
+                self._start(name)
+                return True
+            if self._queued[name] >= route_class.queue:
+                self.rejected[name] += 1
+                return False
+            waiter = _Waiter(name)
+            entry = (route_class.priority, next(self._arrivals), waiter)
+            bisect.insort(self._waiting, entry)
+            self._queued[name] += 1
+            self._peak_queued[name] = max(
+                    self._peak_queued[name], self._queued[name])
+        started = self._clock()
+        waiter.event.wait(route_class.wait_secs)
+        with self._lock:
+            if not waiter.admitted:
+                self._waiting.remove(entry)
+                self._queued[name] -= 1
+                self.timed_out[name] += 1
+                return False
+        self._waits[name].observe(self._clock() - started)
+        return True
+
+    def release(self, name):
+        with self._lock:
+            self._total -= 1
+            self._active[name] -= 1
+            for entry in list(self._waiting):
+                if self._total >= self._max_active:
+                    break
+                waiter = entry[2]
+                if self._active[waiter.name] >= self._classes[
+                        waiter.name].limit:
+                    continue
+                self._waiting.remove(entry)
+                self._queued[waiter.name] -= 1
+                self._start(waiter.name)
+                waiter.admitted = True
+                waiter.event.set()
+
+    def _busy(self, environ, start_response, name):
+        retry_after = self._classes[name].retry_after
+        if environ.get('REQUEST_METHOD') == 'GET':
+            content_type = 'text/html; charset=UTF-8'
+            body = BUSY_PAGE.format(retry_after)
+        else:
+            content_type = 'text/plain; charset=UTF-8'
+            body = BUSY_TEXT.format(retry_after)
+        body = body.encode('utf-8')
+        start_response('503 Service Unavailable', [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', str(retry_after)),
+            ('Cache-Control', 'no-store'),
+        ])
+        return [body]
+
+    def middleware(self, app):
+        controller = self
+
+        def admitted_app(environ, start_response):
+            name = controller.classify(environ)
+            if name is None:
+                return app(environ, start_response)
+            if not controller.acquire(name):
+                return controller._busy(environ, start_response, name)
+            try:
+                result = app(environ, start_response)
+            except BaseException:
+                controller.release(name)
+                raise
+            return profiling.on_close(
+                    environ, result, lambda: controller.release(name))
+
+        return admitted_app
+
+    def stats(self):
+        with self._lock:
+            classes = {
+                name: {
+                    'limit': route_class.limit,
+                    'active': self._active[name],
+                    'queued': self._queued[name],
+                    'peak_queued': self._peak_queued[name],
+                    'admitted': self.admitted[name],
+                    'rejected': self.rejected[name],
+                    'timed_out': self.timed_out[name],
+                }
+                for name, route_class in self._classes.items()}
+            total = self._total
+        for name, summary in classes.items():
+            summary['wait_secs'] = self._waits[name].snapshot()
+        return {
+            'max_active': self._max_active,
+            'active': total,
+            'classes': classes,
+        }
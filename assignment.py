@@ -0,0 +1,298 @@
+"""Hands out ungraded submissions to graders.
+
+Every (prob_id, language) pair gets its own min-heap of ungraded submission
+ids, loaded from the database the first time a grader asks for it and again
+whenever it runs dry, at most once every reload_secs, so submissions
+uploaded through another process show up here too. A grader
+that takes a submission holds a lease on it until it is scored or the lease
+expires, so two graders never get the same submission at the same time.
+
+Each server process has its own GradingQueue, so the heap only proposes
+submissions. The lease that counts is the claim in the lease_grader and
+lease_expires columns of the submission, which claim() takes with one
+conditional UPDATE that only one process can win. A submission is free when
+nobody claimed it or the claim expired; a scored one keeps its grader with
+no expiry and is never claimed again. A submission another process holds
+is kept out of the local heap until that claim runs out.
+
+The waiting and leased counts of a pair come from the claims as well, so
+every process reports the same numbers.
+"""
+
+import datetime
+import heapq
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy import case, select
+from sqlalchemy.sql.expression import func
+
+import models
+
+
+class GradingQueue(object):
+
+    def __init__(self, loader, lease_secs=30 * 60, reload_secs=1,
+                 clock=time.time):
+        # loader(prob_id, language) -> iterable of ungraded submission ids
+        self._loader = loader
+        self._lease_secs = lease_secs
+        self._reload_secs = reload_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._heaps = {}      # key -> heap of submission ids
+        self._loaded = {}     # key -> when its heap was loaded
+        self._queued = {}     # submission id -> key of the heap it waits in
+        self._leases = {}     # submission id -> (key, grader, expires_at)
+        self._by_grader = {}  # (key, grader) -> leased ids, oldest first
+        self._expiry = []     # heap of (expires_at, submission id)
+
+    def _load(self, key, now):
+        ids = [sid for sid in self._loader(*key) if sid not in self._leases]
+        heapq.heapify(ids)
+        self._heaps[key] = ids
+        self._loaded[key] = now
+        for sid in ids:
+            self._queued[sid] = key  # may move it here from another key
+
+    def _ensure_loaded(self, key, now):
+        if key not in self._heaps:
+            self._load(key, now)
+
+    def _push(self, key, sid):
+        if key not in self._heaps or self._queued.get(sid) == key:
+            return
+        heapq.heappush(self._heaps[key], sid)
+        self._queued[sid] = key
+
+    def _pop(self, key):
+        heap = self._heaps[key]
+        while heap:
+            sid = heapq.heappop(heap)
+            if self._queued.get(sid) != key:
+                continue  # scored, moved or pushed twice since
+            del self._queued[sid]
+            return sid
+        return None
+
+    def _release(self, sid):
+        key, grader, _ = self._leases.pop(sid)
+        held = self._by_grader[(key, grader)]
+        held.remove(sid)
+        if not held:
+            del self._by_grader[(key, grader)]
+        return key
+
+    def _expire_leases(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, sid = heapq.heappop(self._expiry)
+            lease = self._leases.get(sid)
+            if lease is None or lease[2] != expires_at:
+                continue  # scored or renewed since
+            key = self._release(sid)
+            self._push(key, sid)
+
+    def _lease(self, key, grader, sid, now, secs=None):
+        expires_at = now + (self._lease_secs if secs is None else secs)
+        if sid not in self._leases:
+            self._by_grader.setdefault((key, grader), []).append(sid)
+        self._leases[sid] = (key, grader, expires_at)
+        heapq.heappush(self._expiry, (expires_at, sid))
+
+    def acquire_batch(self, prob_id, language, grader, count):
+        """Lease up to count of the oldest ungraded submissions to grader.
+
+        Submissions the grader already holds come first, with renewed
+        leases, so asking again before scoring returns the same ones.
+        """
+        key = (prob_id, language)
+        now = self._clock()
+        with self._lock:
+            self._expire_leases(now)
+            self._ensure_loaded(key, now)
+            held = list(self._by_grader.get((key, grader), ()))
+            while len(held) < count:
+                sid = self._pop(key)
+                if sid is None:
+                    # Other processes may have queued more since.
+                    if now - self._loaded[key] < self._reload_secs:
+                        break
+                    self._load(key, now)
+                    continue
+                held.append(sid)
+            for sid in held[:count]:
+                self._lease(key, grader, sid, now)
+            return held[:count]
+
+    def acquire(self, prob_id, language, grader):
+        """Lease the oldest ungraded submission to grader.
+
+        A grader asking again before scoring gets the same submission back
+        with a renewed lease. Returns None when nothing is left.
+        """
+        sids = self.acquire_batch(prob_id, language, grader, 1)
+        return sids[0] if sids else None
+
+    def holds(self, sid, grader, secs):
+        """Whether grader leases sid here for at least secs more."""
+        with self._lock:
+            lease = self._leases.get(sid)
+            return (lease is not None and lease[1] == grader
+                    and lease[2] >= self._clock() + secs)
+
+    def hold(self, sid, grader, secs):
+        """Note that grader holds sid for secs more, through another process.
+
+        Nobody else gets it from here meanwhile. Afterwards it is queued
+        again, in case that grader never scores it.
+        """
+        now = self._clock()
+        with self._lock:
+            if sid in self._leases:
+                key = self._release(sid)
+            else:
+                key = self._queued.pop(sid, None)
+                if key is None:
+                    return
+            self._lease(key, grader, sid, now, secs)
+
+    def complete(self, sid):
+        """Mark a submission as scored so it is never handed out again."""
+        with self._lock:
+            if sid in self._leases:
+                self._release(sid)
+            # Its heap entry is left behind and skipped when popped.
+            self._queued.pop(sid, None)
+
+    def discard(self, sid):
+        """Drop a submission that no longer exists or changed its key."""
+        self.complete(sid)
+
+    def add(self, prob_id, language, sid):
+        """Queue a newly uploaded submission."""
+        with self._lock:
+            if sid not in self._leases:
+                self._push((prob_id, language), sid)
+
+    def invalidate(self):
+        """Forget every loaded queue; they are reloaded on next use.
+
+        Leases survive so that a reload does not hand a leased submission to
+        a second grader.
+        """
+        with self._lock:
+            self._heaps.clear()
+            self._loaded.clear()
+            self._queued.clear()
+
+
+_submissions = models.Submission.__table__
+
+
+def claim(session, sids, grader, now, lease_secs):
+    """Claim sids for grader until now + lease_secs; returns the ids won.
+
+    A submission is won if it is free or grader already holds it, which
+    renews the claim. now is a naive UTC datetime.
+    """
+    if not sids:
+        return set()
+    grader = grader or ''  # a NULL grader would read as free
+    expires = now + datetime.timedelta(seconds=lease_secs)
+    sub = _submissions
+    session.execute(sub.update().where(sub.c.uid.in_(sids)).where(
+            sqlalchemy.or_(
+                sub.c.lease_grader.is_(None),
+                sub.c.lease_expires < now,
+                sqlalchemy.and_(sub.c.lease_grader == grader,
+                                sub.c.lease_expires.isnot(None))))
+            .values(lease_grader=grader, lease_expires=expires))
+    return {sid for sid, in session.execute(
+            select([sub.c.uid]).where(sub.c.uid.in_(sids))
+            .where(sub.c.lease_grader == grader)
+            .where(sub.c.lease_expires == expires))}
+
+
+def holders(session, sids):
+    """(uid, grader, expires) of the claims on sids.
+
+    expires is None once the submission is scored.
+    """
+    if not sids:
+        return []
+    sub = _submissions
+    return session.execute(select(
+            [sub.c.uid, sub.c.lease_grader, sub.c.lease_expires]).where(
+                sub.c.uid.in_(sids))).fetchall()
+
+
+def mark_scored(session, sids):
+    """Keep sids claimed for good; call in the transaction storing a score."""
+    sub = _submissions
+    session.execute(sub.update().where(sub.c.uid.in_(sids)).values(
+            lease_grader=func.coalesce(sub.c.lease_grader, ''),
+            lease_expires=None))
+
+
+def unclaim(session, sids):
+    """Make sids free again, e.g. after their scores were removed."""
+    sub = _submissions
+    session.execute(sub.update().where(sub.c.uid.in_(sids)).values(
+            lease_grader=None, lease_expires=None))
+
+
+def claim_counts(session, prob_id, language, now):
+    """Waiting and leased submissions of one key, from the claims."""
+    sub = _submissions
+    scores = models.Score.__table__
+    free = sqlalchemy.or_(sub.c.lease_grader.is_(None),
+                          sub.c.lease_expires < now)
+    held = sub.c.lease_expires >= now
+    waiting, leased = session.execute(select([
+            func.sum(case([(free, 1)], else_=0)),
+            func.sum(case([(held, 1)], else_=0))]).where(
+                sub.c.prob_id == prob_id).where(
+                sub.c.language == language).where(
+                ~sqlalchemy.exists().where(
+                    scores.c.submission_id == sub.c.uid))).first()
+    return {'waiting': waiting or 0, 'leased': leased or 0}
+
+
+class QueueCounts(object):
+    """claim_counts() of each key, cached for ttl_secs.
+
+    Keeps frequent queue polling from running a COUNT every time.
+    """
+
+    def __init__(self, loader, ttl_secs=2, clock=time.time):
+        # loader(prob_id, language) -> counts, as claim_counts returns them
+        self._loader = loader
+        self._ttl_secs = ttl_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (loaded_at, counts)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prob_id, language):
+        key = (prob_id, language)
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self._ttl_secs:
+                self.hits += 1
+                return dict(entry[1])
+            self.misses += 1
+        counts = self._loader(*key)
+        with self._lock:
+            self._entries[key] = (now, counts)
+        return dict(counts)
+
+    def invalidate(self, prob_id, language):
+        with self._lock:
+            self._entries.pop((prob_id, language), None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,97 @@
+"""Compares translations.I18nManager with the original list-of-rows class.
+
+    python benchmarks/bench_i18n.py --rows 400 --locales 20
+
+Uses --csv when given, otherwise a generated translation file. Reports the
+memory held after construction (plus one locale for the lazy class) and
+the cost of the text() calls made by one problem page render. Prints one
+JSON object.
+"""
+
+import argparse
+import csv
+import gc
+import json
+import os
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import translations  # noqa: E402
+
+
+class LegacyI18nManager(object):
+    """The class main.py used before translations.py."""
+
+    def __init__(self, csv_path):
+        with open(csv_path) as f:
+            reader = csv.reader(f)
+            self._contents = list(reader)
+            self.all_locales = self._contents[0]
+            self.locales_to_index = {
+                    locale : i for i, locale in enumerate(self.all_locales)}
+            self.name_to_index = {
+                    locale : i for i, locale in enumerate(self._contents[1])}
+
+    def text(self, position, locale):
+        lpos = self.locales_to_index[locale]
+        return self._contents[position - 1][lpos]
+
+
+# text() calls of one problems.html render: heading, four problem labels,
+# ten answer languages twice per problem and the size alert.
+RENDER_POSITIONS = ([43, 93, 95, 106, 112, 69] +
+                    [p for p in range(47, 57) for _ in range(8)])
+
+
+def write_csv(path, rows, locales):
+    codes = ['l{}'.format(i) for i in range(locales)]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(codes)
+        writer.writerow(['Language {}'.format(i) for i in range(locales)])
+        for r in range(rows - 2):
+            writer.writerow(['row {} in {} '.format(r, c) * 4 for c in codes])
+    return codes
+
+
+def measure(cls, path, locale, repeat):
+    gc.collect()
+    tracemalloc.start()
+    manager = cls(path)
+    manager.text(1, locale)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    render = lambda: [manager.text(p, locale) for p in RENDER_POSITIONS]
+    seconds = min(timeit.repeat(render, number=repeat, repeat=5)) / repeat
+    return {'bytes_held': held, 'us_per_render': round(seconds * 1e6, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv', default='')
+    parser.add_argument('--rows', type=int, default=400)
+    parser.add_argument('--locales', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.csv
+        if not path:
+            path = os.path.join(tmp, 'text.csv')
+            write_csv(path, max(args.rows, max(RENDER_POSITIONS)), args.locales)
+        with open(path) as f:
+            locale = next(csv.reader(f))[0]
+        result = {
+            'legacy': measure(LegacyI18nManager, path, locale, args.repeat),
+            'lazy': measure(translations.I18nManager, path, locale,
+                            args.repeat),
+        }
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
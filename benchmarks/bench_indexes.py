@@ -0,0 +1,103 @@
+"""Latency of the hot lookups before and after migrations.add_missing_indexes.
+
+    python benchmarks/bench_indexes.py --users 20000
+
+Builds a throwaway SQLite database, drops every secondary index, times the
+queries, adds the indexes back through the migration and times them again.
+Prints one JSON object.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+
+import dataset
+
+import migrations  # noqa: E402  (path set up by dataset)
+import models  # noqa: E402
+
+
+def drop_indexes(engine):
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(engine)
+
+
+def queries(info, rand):
+    uuids = info['access_uuids']
+    user_ids = info['user_ids']
+    graders = info['graders'] or ['nobody']
+    User, Submission, Score = models.User, models.Submission, models.Score
+    return {
+        'user_by_access_uuid': lambda s: s.query(User).filter_by(
+            access_uuid=rand.choice(uuids)).first(),
+        'submission_by_user_prob': lambda s: s.query(Submission).filter_by(
+            user_id=rand.choice(user_ids),
+            prob_id=rand.choice(dataset.DAY1_PROBS)).first(),
+        'ungraded_by_prob_lang': lambda s: s.query(Submission.uid).outerjoin(
+            Score).filter(
+            Submission.prob_id == rand.choice(dataset.DAY1_PROBS),
+            Submission.language == rand.choice(dataset.LANGUAGES),
+            Score.uid.is_(None)).all(),
+        'scores_by_grader': lambda s: s.query(Score.submission_id).filter_by(
+            grader=rand.choice(graders)).all(),
+        'scores_by_submission': lambda s: s.query(Score).filter_by(
+            submission_id=rand.randrange(1, info['submissions'] + 1)).all(),
+        'active_exam_papers': lambda s: s.query(models.ExamPaper).filter_by(
+            is_active=True, test_name='hard_day_1').all(),
+    }
+
+
+def time_queries(Session, info, repeat, seed):
+    results = {}
+    for name, run in sorted(queries(info, random.Random(seed)).items()):
+        session = Session()
+        try:
+            started = time.perf_counter()
+            for _ in range(repeat):
+                run(session)
+            elapsed = time.perf_counter() - started
+        finally:
+            session.close()
+        results[name] = round(elapsed / repeat * 1000, 4)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sqlalchemy.create_engine(
+                'sqlite:///' + os.path.join(tmp, 'bench.sqlite'))
+        info = dataset.populate(engine, users=args.users, seed=args.seed)
+        drop_indexes(engine)
+        Session = sqlalchemy.orm.sessionmaker(bind=engine)
+        before = time_queries(Session, info, args.repeat, args.seed)
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            migrations.add_missing_indexes(engine)
+        finally:
+            sys.stdout = stdout
+        after = time_queries(Session, info, args.repeat, args.seed)
+
+    print(json.dumps({
+        'users': info['users'],
+        'submissions': info['submissions'],
+        'scores': info['scores'],
+        'ms_per_query': {name: {'before': before[name], 'after': after[name]}
+                         for name in before},
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
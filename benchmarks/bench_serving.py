@@ -0,0 +1,203 @@
+"""Throughput of the server modes while slow uploads are in flight.
+
+    python benchmarks/bench_serving.py --workers 4 --slow_uploads 8
+
+For each mode (plain bottle.run, --serve threaded, --serve async) starts
+main.py on a throwaway SQLite database, opens --slow_uploads connections that
+trickle a multipart upload a few bytes at a time, and meanwhile fires
+--requests fast candidate page loads from --concurrency threads. Prints one
+JSON object with requests per second and latency percentiles per mode.
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import sqlalchemy
+
+import dataset
+import loadtest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {
+    'bottle.run': [],
+    'threaded': ['--serve', 'threaded'],
+    'async': ['--serve', 'async'],
+}
+
+
+def write_config(conn_string, workdir):
+    config = loadtest.install_config(conn_string, workdir)
+    with open(os.path.join(workdir, 'config.py'), 'w') as f:
+        for name in ('CONN_STRING', 'TEXT_STR', 'FILE_SAVE_DIR',
+                     'STATIC_FILE_URL'):
+            f.write('{} = {!r}\n'.format(name, getattr(config, name)))
+
+
+def wait_listening(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('server exited with {}'.format(proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start on port {}'.format(port))
+
+
+def slow_upload(port, info, upload_bytes, stop, rand):
+    """Trickle one upload until stop is set or the body is sent."""
+    i = rand.randrange(len(info['access_uuids']))
+    body, content_type = loadtest.multipart({
+        'prob_id': rand.choice(dataset.DAY1_PROBS),
+        'user_id': info['user_ids'][i],
+        'language': 'English',
+        'link': '',
+    }, 'answer.pdf', b'%PDF-1.4\n' + os.urandom(upload_bytes))
+    sock = socket.create_connection(('127.0.0.1', port))
+    try:
+        sock.sendall((
+            'POST /upload_solution/{} HTTP/1.1\r\nHost: localhost\r\n'
+            'Content-Type: {}\r\nContent-Length: {}\r\n'
+            'Connection: close\r\n\r\n').format(
+                info['access_uuids'][i], content_type, len(body)).encode())
+        for offset in range(0, len(body), 64):
+            if stop.is_set():
+                return
+            sock.sendall(body[offset:offset + 64])
+            time.sleep(0.01)
+        sock.recv(1024)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def fast_gets(port, info, total, concurrency, seed):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker(worker_id):
+        rand = random.Random(seed * 1000 + worker_id)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            started = time.perf_counter()
+            try:
+                conn.request('GET', '/user/' + rand.choice(
+                    info['access_uuids']), headers={'Connection': 'close'})
+                response = conn.getresponse()
+                response.read()
+                failed = response.status >= 500
+            except (OSError, http.client.HTTPException):
+                failed = True
+            finally:
+                conn.close()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += failed
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / wall, 2) if wall else None,
+        'p50_ms': ms(loadtest.percentile(latencies, 50)),
+        'p95_ms': ms(loadtest.percentile(latencies, 95)),
+        'p99_ms': ms(loadtest.percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+    }
+
+
+def run_mode(mode, args, info, workdir):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = workdir + os.pathsep + env.get('PYTHONPATH', '')
+    command = [sys.executable, 'main.py', '--port', str(args.port)]
+    if MODES[mode]:
+        command += MODES[mode] + ['--workers', str(args.workers)]
+    log = open(os.path.join(workdir, mode + '.log'), 'w')
+    proc = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log,
+                            stderr=subprocess.STDOUT)
+    stop = threading.Event()
+    uploads = []
+    try:
+        wait_listening(args.port, proc)
+        rand = random.Random(args.seed)
+        for _ in range(args.slow_uploads):
+            thread = threading.Thread(
+                    target=slow_upload,
+                    args=(args.port, info, args.upload_kb * 1024, stop,
+                          random.Random(rand.random())))
+            thread.start()
+            uploads.append(thread)
+        time.sleep(0.5)
+        return fast_gets(args.port, info, args.requests, args.concurrency,
+                         args.seed)
+    finally:
+        stop.set()
+        for thread in uploads:
+            thread.join()
+        proc.terminate()
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--slow_uploads', type=int, default=8)
+    parser.add_argument('--upload_kb', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--port', type=int, default=18099)
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-serving-')
+    try:
+        conn = 'sqlite:///{}?timeout=60'.format(
+                os.path.join(workdir, 'exam.sqlite'))
+        write_config(conn, workdir)
+        info = dataset.populate(sqlalchemy.create_engine(conn),
+                                users=args.users, seed=args.seed)
+        results = {}
+        for mode in args.modes.split(','):
+            results[mode] = run_mode(mode, args, info, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({'params': vars(args), 'modes': results},
+                     indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Synthetic exam data for the benchmarks.
+
+populate() fills an empty database through Core multi-row inserts and
+returns what the drivers need to build requests against it.
+"""
+
+import datetime
+import os
+import random
+import sys
+
+import sqlalchemy.orm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import contests  # noqa: E402
+import models  # noqa: E402
+import roster  # noqa: E402
+
+
+LANGUAGES = ['English', 'Spanish', 'French', 'Arabic', 'Russian']
+DAY1_PROBS = [101, 102, 103, 104]
+DAY2_PROBS = [105, 106, 107, 108]
+
+
+def _insert(conn, table, rows, batch_size=5000):
+    for batch in roster.batched(rows, batch_size):
+        conn.execute(table.insert(), batch)
+
+
+def populate(engine, users=1000, submit_ratio=0.8, scores_per_submission=2,
+             graded_ratio=0.5, seed=0):
+    """Create the schema and fill it; returns a dict describing the data.
+
+    Each user answers every problem with probability submit_ratio, and
+    graded_ratio of the submissions get scores_per_submission scores.
+    Everything belongs to the legacy contest, whose rounds are DAY1_PROBS
+    and DAY2_PROBS.
+    """
+    rand = random.Random(seed)
+    models.Base.metadata.create_all(engine)
+    start = datetime.datetime(2020, 5, 9, 12, 0, 0)
+    tokens = ['{:032x}'.format(rand.getrandbits(128)) for _ in range(users)]
+    user_rows = [{
+        'uid': i + 1,
+        'email': 'candidate{}@example.com'.format(i),
+        'access_uuid': tokens[i],
+        'start_timestamp': start,
+        'day2_timestamp': start + datetime.timedelta(days=1),
+    } for i in range(users)]
+
+    submissions = []
+    scores = []
+    summaries = []
+    for user in user_rows:
+        language = rand.choice(LANGUAGES)
+        for prob_id in DAY1_PROBS + DAY2_PROBS:
+            if rand.random() >= submit_ratio:
+                continue
+            sid = len(submissions) + 1
+            submissions.append({
+                'uid': sid,
+                'user_id': user['uid'],
+                'prob_id': prob_id,
+                'language': language,
+                'link': 'files/{:064x}.pdf'.format(rand.getrandbits(256)),
+                'timestamp': start + datetime.timedelta(
+                    seconds=rand.randrange(5 * 3600)),
+            })
+            given = []
+            if rand.random() < graded_ratio:
+                for n in range(scores_per_submission):
+                    value = rand.choice([-1, 0, 1, 2, 5, 6, 7, 7])
+                    given.append(value)
+                    scores.append({
+                        'submission_id': sid,
+                        'grader': 'grader{}'.format(rand.randrange(30)),
+                        'score': value,
+                        'comment': '',
+                        'timestamp': start,
+                    })
+            valid = [v for v in given if v != -1]
+            summaries.append({
+                'submission_id': sid,
+                'num_scores': len(given),
+                'min_score': min(given) if given else None,
+                'max_score': max(given) if given else None,
+                'num_valid': len(valid),
+                'min_valid': min(valid) if valid else None,
+                'max_valid': max(valid) if valid else None,
+            })
+
+    exams = [{'test_name': name, 'language': language,
+              'link': 'http://example.com/{}/{}.pdf'.format(name, language),
+              'is_active': True}
+             for name in ('hard_day_1', 'hard_day_2')
+             for language in LANGUAGES]
+
+    with engine.begin() as conn:
+        _insert(conn, models.User.__table__, user_rows)
+        _insert(conn, models.Submission.__table__, submissions)
+        _insert(conn, models.Score.__table__, scores)
+        _insert(conn, models.ScoreSummary.__table__, summaries)
+        _insert(conn, models.ExamPaper.__table__, exams)
+        contest_id = contests.adopt_legacy(
+                sqlalchemy.orm.Session(bind=conn))
+
+    return {
+        'contest_id': contest_id,
+        'users': len(user_rows),
+        'submissions': len(submissions),
+        'scores': len(scores),
+        'access_uuids': tokens,
+        'user_ids': [u['uid'] for u in user_rows],
+        'graders': sorted({s['grader'] for s in scores}),
+    }
@@ -0,0 +1,272 @@
+"""Exam-day load test of the bottle application.
+
+    python benchmarks/loadtest.py --users 2000 --concurrency 32 --requests 500
+
+Fills a throwaway SQLite database (or the empty database named by --conn)
+with dataset.populate(), then calls main.application directly
+as a WSGI app from --concurrency threads, one endpoint at a time. Prints a
+JSON report with p50/p95/p99 latency in milliseconds and requests per second
+per endpoint, plus the number of transactions committed per route;
+--output also writes it to a file so runs can be compared.
+--score_flush_secs turns on the write-behind score log.
+"""
+
+import argparse
+import concurrent.futures
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from wsgiref.util import setup_testing_defaults
+
+import dataset
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOUNDARY = 'loadtestboundary'
+
+
+def install_config(conn_string, workdir, score_flush_secs=0):
+    """Register the config module main.py imports."""
+    text_csv = os.path.join(workdir, 'text.csv')
+    locales = ['en', 'es']
+    with open(text_csv, 'w') as f:
+        f.write(','.join(locales) + '\n')
+        f.write('English,Spanish\n')
+        for row in range(3, 130):
+            f.write(','.join('text {} {}'.format(row, l) for l in locales))
+            f.write('\n')
+    files = os.path.join(workdir, 'files')
+    os.makedirs(files, exist_ok=True)
+    config = types.ModuleType('config')
+    config.CONN_STRING = conn_string
+    config.TEXT_STR = text_csv
+    config.FILE_SAVE_DIR = files
+    config.STATIC_FILE_URL = 'files'
+    # Previews start on the first upload; they are not part of this load.
+    config.PREVIEW_WORKERS = 0
+    if score_flush_secs:
+        config.SCORE_WAL_DIR = os.path.join(workdir, 'score-wal')
+        config.SCORE_FLUSH_SECS = score_flush_secs
+    sys.modules['config'] = config
+    return config
+
+
+def wsgi_call(app, method, path, query='', body=b'', content_type=None):
+    environ = {}
+    setup_testing_defaults(environ)
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    })
+    if content_type:
+        environ['CONTENT_TYPE'] = content_type
+    status = []
+
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+
+    result = app(environ, start_response)
+    try:
+        for _ in result:
+            pass
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return int(status[0].split()[0])
+
+
+def multipart(fields, filename, content):
+    parts = []
+    for name, value in fields.items():
+        parts.append((
+            '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n'
+            '{}\r\n').format(BOUNDARY, name, value).encode())
+    parts.append((
+        '--{}\r\nContent-Disposition: form-data; name="upload"; '
+        'filename="{}"\r\nContent-Type: application/pdf\r\n\r\n').format(
+            BOUNDARY, filename).encode() + content + b'\r\n')
+    parts.append('--{}--\r\n'.format(BOUNDARY).encode())
+    return b''.join(parts), 'multipart/form-data; boundary=' + BOUNDARY
+
+
+def endpoints(info, upload_bytes):
+    """name -> function(app, rand) making one request, returning status."""
+    uuids = info['access_uuids']
+    graders = info['graders'] or ['grader0']
+
+    def landing(app, rand):
+        return wsgi_call(app, 'GET', '/user/' + rand.choice(uuids))
+
+    def problems(app, rand):
+        return wsgi_call(app, 'GET',
+                         '/user/{}/prob/jiwls'.format(rand.choice(uuids)),
+                         'lang=en')
+
+    def upload(app, rand):
+        i = rand.randrange(len(uuids))
+        content = b'%PDF-1.4\n' + os.urandom(upload_bytes)
+        body, content_type = multipart({
+            'prob_id': rand.choice(dataset.DAY1_PROBS),
+            'user_id': info['user_ids'][i],
+            'language': 'English',
+            'link': '',
+        }, 'answer.pdf', content)
+        return wsgi_call(app, 'POST', '/upload_solution/' + uuids[i],
+                         body=body, content_type=content_type)
+
+    def next_submission(app, rand):
+        return wsgi_call(app, 'GET', '/submission',
+                         'prob_id={}&lang={}&not_graded_by={}'.format(
+                             rand.choice(dataset.DAY1_PROBS),
+                             rand.choice(dataset.LANGUAGES),
+                             rand.choice(graders)))
+
+    def post_score(app, rand):
+        body = json.dumps({'grader': rand.choice(graders), 'comment': '',
+                           'score': rand.randrange(8)}).encode()
+        return wsgi_call(app, 'POST', '/submission/{}/score'.format(
+            rand.randrange(1, info['submissions'] + 1)), body=body)
+
+    def scores_csv(app, rand):
+        return wsgi_call(app, 'GET', '/supersecreteurl/vitafusion/scores.csv')
+
+    def scores2_csv(app, rand):
+        return wsgi_call(app, 'GET', '/supersecreteurl/vitafusion/scores2.csv')
+
+    return [
+        ('GET /user/<uid>', landing),
+        ('GET /user/<uid>/prob/<pid>', problems),
+        ('POST /upload_solution/<uid>', upload),
+        ('GET /submission', next_submission),
+        ('POST /submission/<uid>/score', post_score),
+        ('GET scores.csv', scores_csv),
+        ('GET scores2.csv', scores2_csv),
+    ]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_endpoint(app, request, total, concurrency, seed):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker(worker_id):
+        rand = random.Random(seed * 1000 + worker_id)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            started = time.perf_counter()
+            try:
+                failed = request(app, rand) >= 500
+            except Exception:
+                failed = True
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += failed
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / wall, 2) if wall else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=300,
+                        help='requests per endpoint')
+    parser.add_argument('--export_requests', type=int, default=5,
+                        help='requests for each scores.csv export')
+    parser.add_argument('--upload_kb', type=int, default=256)
+    parser.add_argument('--conn', default='',
+                        help='empty database to fill instead of a temp '
+                             'SQLite file')
+    parser.add_argument('--only', default='',
+                        help='comma separated endpoint names to run')
+    parser.add_argument('--score_flush_secs', type=float, default=0,
+                        help='log scores and store them in batches this often')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='')
+    args = parser.parse_args()
+
+    # The handlers print; keep stdout for the report.
+    report_out, sys.stdout = sys.stdout, sys.stderr
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        conn = args.conn or 'sqlite:///{}?timeout=60'.format(
+                os.path.join(workdir, 'exam.sqlite'))
+        install_config(conn, workdir, args.score_flush_secs)
+        os.chdir(ROOT)
+        import main as exam
+
+        started = time.perf_counter()
+        info = dataset.populate(exam.engine, users=args.users, seed=args.seed)
+        populate_secs = time.perf_counter() - started
+
+        only = set(filter(None, args.only.split(',')))
+        results = {}
+        for name, request in endpoints(info, args.upload_kb * 1024):
+            if only and name not in only:
+                continue
+            total = (args.export_requests if name.endswith('.csv')
+                     else args.requests)
+            results[name] = run_endpoint(
+                    exam.application, request, total, args.concurrency,
+                    args.seed)
+        if exam.score_writer is not None:
+            exam.score_writer.flush()
+        transactions = exam.db_monitor.stats()['transaction_secs']
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        sys.stdout = report_out
+
+    report = {
+        'params': vars(args),
+        'python': platform.python_version(),
+        'dataset': {k: info[k] for k in ('users', 'submissions', 'scores')},
+        'populate_secs': round(populate_secs, 3),
+        'endpoints': results,
+        'transactions': {route: summary['count']
+                         for route, summary in transactions.items()},
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
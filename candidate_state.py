@@ -0,0 +1,93 @@
+"""In-process cache of what the exam pages need to know about a candidate.
+
+A CandidateState holds the candidate's contest, the start time of each
+round begun and the problems submitted, keyed by access uuid. Start times
+never change once set, so they are cached for good; the submitted set is
+updated write-through by uploads handled in this process and reloaded after
+ttl_secs, or on demand, to pick up uploads handled by other workers.
+"""
+
+from collections import namedtuple, OrderedDict
+import threading
+import time
+
+
+CandidateState = namedtuple(
+        'CandidateState',
+        ['uid', 'access_uuid', 'contest_id', 'starts', 'submitted'])
+# starts maps a round uid to the time the candidate began it
+
+
+class CandidateCache(object):
+
+    def __init__(self, loader, starter, ttl_secs=60, max_entries=10000,
+                 clock=time.time):
+        # loader(access_uuid) -> CandidateState, or None for unknown ids
+        # starter(user uid, round uid, now) -> the start the round ends up with
+        self._loader = loader
+        self._starter = starter
+        self._ttl_secs = ttl_secs
+        self._max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # access_uuid -> (loaded_at, state)
+        self.hits = 0
+        self.misses = 0
+        self.starts = 0
+
+    def _store(self, state, loaded_at):
+        self._entries[state.access_uuid] = (loaded_at, state)
+        self._entries.move_to_end(state.access_uuid)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, access_uuid, refresh=False):
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(access_uuid)
+            if (entry is not None and not refresh
+                    and now - entry[0] < self._ttl_secs):
+                self.hits += 1
+                self._entries.move_to_end(access_uuid)
+                return entry[1]
+            self.misses += 1
+        state = self._loader(access_uuid)
+        if state is not None:
+            with self._lock:
+                self._store(state, now)
+        return state
+
+    def start_time(self, state, round_id, now):
+        """When the candidate began round round_id.
+
+        The first call for a round records now through the starter, whose
+        insert only one racing request wins; the others get its value.
+        """
+        value = state.starts.get(round_id)
+        if value is not None:
+            return value
+        value = self._starter(state.uid, round_id, now)
+        with self._lock:
+            self.starts += 1
+            entry = self._entries.get(state.access_uuid)
+            if entry is not None:
+                starts = dict(entry[1].starts)
+                starts[round_id] = value
+                self._store(entry[1]._replace(starts=starts), entry[0])
+        return value
+
+    def add_submission(self, access_uuid, prob_id):
+        with self._lock:
+            entry = self._entries.get(access_uuid)
+            if entry is not None and prob_id not in entry[1].submitted:
+                submitted = entry[1].submitted | {prob_id}
+                self._store(entry[1]._replace(submitted=submitted), entry[0])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'starts': self.starts,
+                'entries': len(self._entries),
+            }
@@ -0,0 +1,219 @@
+"""Contests and their rounds: the structure every exam page follows.
+
+A contest owns its candidates (User.contest_id) and their submissions
+(Submission.contest_id, copied from the candidate on upload). Reports and
+resolution therefore read one contest through the (contest_id, ...)
+indexes, however many past contests the tables hold.
+
+A round is one sitting of a contest. It has a slug in its problem page
+URL, an ExamPaper test_name for its papers, a block of num_problems
+problem ids starting at first_prob_id, a duration, and the level of its
+statements in problems/<language>/<level>.txt. Problem ids never overlap
+between rounds, even across contests, so a prob_id alone names its round
+and the grading queues keep (prob_id, language) as their key.
+
+ContestRegistry caches every round in process. The tables are tiny and
+change only when a contest is created.
+"""
+
+from collections import namedtuple
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy import select
+
+import models
+
+
+Contest = namedtuple('Contest', ['uid', 'name', 'is_active'])
+Round = namedtuple(
+        'Round', ['uid', 'contest_id', 'position', 'label', 'slug',
+                  'test_name', 'first_prob_id', 'num_problems',
+                  'duration_mins', 'problem_level'])
+
+ROUND_FIELDS = Round._fields[2:]  # what create() needs for each round
+
+# The exam that used to be hardcoded: two five-hour days of four problems.
+LEGACY_CONTEST = 'gqmo'
+LEGACY_ROUNDS = [
+    {'position': 1, 'label': 'Day 1', 'slug': 'jiwls',
+     'test_name': 'hard_day_1', 'first_prob_id': 101, 'num_problems': 4,
+     'duration_mins': 300, 'problem_level': 'easy'},
+    {'position': 2, 'label': 'Day 2', 'slug': 'oweiur',
+     'test_name': 'hard_day_2', 'first_prob_id': 105, 'num_problems': 4,
+     'duration_mins': 300, 'problem_level': 'hard'},
+]
+# User columns that held the start of each legacy round, by position.
+LEGACY_START_COLUMNS = {1: 'start_timestamp', 2: 'day2_timestamp'}
+
+
+def prob_ids(exam_round):
+    return range(exam_round.first_prob_id,
+                 exam_round.first_prob_id + exam_round.num_problems)
+
+
+def load(session):
+    """(contests, rounds) of every contest, as namedtuples."""
+    contests = models.Contest.__table__
+    rounds = models.ContestRound.__table__
+    return (
+        [Contest(*row) for row in session.execute(select(
+            [contests.c[name] for name in Contest._fields]).order_by(
+                contests.c.uid))],
+        [Round(*row) for row in session.execute(select(
+            [rounds.c[name] for name in Round._fields]).order_by(
+                rounds.c.contest_id, rounds.c.position))],
+    )
+
+
+def create(session, name, rounds, is_active=True):
+    """Add a contest with rounds (dicts of ROUND_FIELDS); returns its uid.
+
+    Raises ValueError if a round's problem ids overlap an existing round.
+    """
+    new = [Round(None, None, **{field: r[field] for field in ROUND_FIELDS})
+           for r in rounds]
+    existing = load(session)[1]
+    for i, exam_round in enumerate(new):
+        for other in new[i + 1:] + existing:
+            if set(prob_ids(exam_round)) & set(prob_ids(other)):
+                raise ValueError(
+                        'problems of round {} overlap round {}'.format(
+                            exam_round.slug, other.slug))
+    contest = models.Contest(name=name, is_active=is_active)
+    session.add(contest)
+    session.flush()
+    for r in rounds:
+        session.add(models.ContestRound(
+                contest_id=contest.uid,
+                **{field: r[field] for field in ROUND_FIELDS}))
+    session.flush()
+    return contest.uid
+
+
+def adopt_legacy(session, problem_levels=None):
+    """Move the data from before contests into LEGACY_CONTEST.
+
+    Creates the contest with LEGACY_ROUNDS if needed. Every user and
+    submission without a contest joins it, and the old start time columns
+    are copied into round_starts. problem_levels maps a test name to its
+    problem file level, as PROBLEM_LEVELS used to. Safe to run again;
+    returns the contest uid.
+    """
+    contest_id = session.execute(select([models.Contest.uid]).where(
+            models.Contest.name == LEGACY_CONTEST)).scalar()
+    if contest_id is None:
+        problem_levels = problem_levels or {}
+        contest_id = create(session, LEGACY_CONTEST, [
+                dict(r, problem_level=problem_levels.get(
+                    r['test_name'], r['problem_level']))
+                for r in LEGACY_ROUNDS])
+    users = models.User.__table__
+    submissions = models.Submission.__table__
+    starts = models.RoundStart.__table__
+    session.execute(users.update().where(users.c.contest_id.is_(None))
+                    .values(contest_id=contest_id))
+    session.execute(submissions.update().where(
+            submissions.c.contest_id.is_(None)).values(
+                contest_id=select([users.c.contest_id]).where(
+                    users.c.uid == submissions.c.user_id).as_scalar()))
+    rounds = models.ContestRound.__table__
+    for round_id, position in session.execute(
+            select([rounds.c.uid, rounds.c.position]).where(
+                rounds.c.contest_id == contest_id)):
+        column = users.c[LEGACY_START_COLUMNS[position]]
+        started = sqlalchemy.exists().where(
+                starts.c.user_id == users.c.uid).where(
+                starts.c.round_id == round_id)
+        session.execute(starts.insert().from_select(
+                ['user_id', 'round_id', 'started'],
+                select([users.c.uid, sqlalchemy.literal(round_id), column])
+                .where(users.c.contest_id == contest_id)
+                .where(column.isnot(None))
+                .where(~started)))
+    return contest_id
+
+
+class _Index(object):
+
+    def __init__(self, contests, rounds):
+        self.contests = {c.uid: c for c in contests}
+        self.by_name = {c.name: c for c in contests}
+        self.rounds = {}  # contest uid -> rounds by position
+        self.by_slug = {}
+        self.by_prob_id = {}
+        for r in rounds:
+            self.rounds.setdefault(r.contest_id, []).append(r)
+            self.by_slug[r.slug] = r
+            for prob_id in prob_ids(r):
+                self.by_prob_id[prob_id] = r
+        active = [c for c in contests if c.is_active]
+        self.current = active[-1] if active else None
+
+
+class ContestRegistry(object):
+
+    def __init__(self, loader, ttl_secs=30, clock=time.time):
+        # loader() -> (contests, rounds), as load() returns them
+        self._loader = loader
+        self._ttl_secs = ttl_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._index = None
+        self._loaded_at = None
+        self._generation = 0
+        self.loads = 0
+
+    def _current_index(self):
+        now = self._clock()
+        with self._lock:
+            if (self._index is not None
+                    and now - self._loaded_at < self._ttl_secs):
+                return self._index
+            generation = self._generation
+        index = _Index(*self._loader())
+        with self._lock:
+            self.loads += 1
+            # Do not store rows read before a concurrent invalidation.
+            if generation == self._generation:
+                self._index = index
+                self._loaded_at = now
+        return index
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._index = None
+
+    def contest(self, name):
+        return self._current_index().by_name.get(name)
+
+    def current(self):
+        """The most recently created active contest, or None."""
+        return self._current_index().current
+
+    def rounds(self, contest_id):
+        return tuple(self._current_index().rounds.get(contest_id, ()))
+
+    def active_rounds(self):
+        index = self._current_index()
+        return tuple(r for uid, contest in index.contests.items()
+                     if contest.is_active
+                     for r in index.rounds.get(uid, ()))
+
+    def by_slug(self, slug):
+        return self._current_index().by_slug.get(slug)
+
+    def for_prob_id(self, prob_id):
+        return self._current_index().by_prob_id.get(prob_id)
+
+    def stats(self):
+        index = self._current_index()
+        return {
+            'contests': len(index.contests),
+            'active': sorted(c.name for c in index.contests.values()
+                             if c.is_active),
+            'rounds': len(index.by_slug),
+            'loads': self.loads,
+        }
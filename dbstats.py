@@ -0,0 +1,76 @@
+"""Connection pool settings and instrumentation."""
+
+import threading
+
+import sqlalchemy
+from sqlalchemy import event
+
+import metrics
+
+
+def engine_options(config):
+    """Keyword arguments for create_engine built from config.
+
+    SQLite does not use a QueuePool, so only recycle and pre-ping apply.
+    """
+    options = {
+        'pool_recycle': getattr(config, 'POOL_RECYCLE', 3600),
+        'pool_pre_ping': getattr(config, 'POOL_PRE_PING', True),
+    }
+    url = sqlalchemy.engine.url.make_url(config.CONN_STRING)
+    if url.get_backend_name() != 'sqlite':
+        options.update({
+            'pool_size': getattr(config, 'POOL_SIZE', 5),
+            'max_overflow': getattr(config, 'POOL_MAX_OVERFLOW', 10),
+            'pool_timeout': getattr(config, 'POOL_TIMEOUT', 30),
+        })
+    return options
+
+
+class PoolMonitor(object):
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.checkout_wait = metrics.Summary()
+        self.transactions = metrics.SummaryGroup()
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record,
+                     connection_proxy):
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use -= 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def stats(self):
+        with self._lock:
+            pool = {
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'connects': self.connects,
+                'timeouts': self.timeouts,
+                'status': self._engine.pool.status(),
+            }
+        return {
+            'pool': pool,
+            'checkout_wait_secs': self.checkout_wait.snapshot(),
+            'transaction_secs': self.transactions.snapshot(),
+        }
@@ -0,0 +1,62 @@
+"""In-process cache of the active exam papers for each test name.
+
+Writes made through this process invalidate the cache directly. Other
+worker processes only see them once the TTL runs out.
+"""
+
+from collections import namedtuple
+import threading
+import time
+
+
+ExamPaperRow = namedtuple(
+        'ExamPaperRow', ['uid', 'test_name', 'language', 'link', 'is_active'])
+
+
+class ExamPaperCache(object):
+
+    def __init__(self, loader, ttl_secs=30, clock=time.time):
+        # loader(test_name) -> list of ExamPaperRow for the active papers
+        self._loader = loader
+        self._ttl_secs = ttl_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}  # test_name -> (loaded_at, rows)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def active_papers(self, test_name):
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(test_name)
+            if entry is not None and now - entry[0] < self._ttl_secs:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        rows = tuple(self._loader(test_name))
+        with self._lock:
+            # Do not store rows read before a concurrent invalidation.
+            if generation == self._generation:
+                self._entries[test_name] = (now, rows)
+        return rows
+
+    def is_active(self, test_name):
+        return bool(self.active_papers(test_name))
+
+    def invalidate(self, test_name=None):
+        with self._lock:
+            self._generation += 1
+            if test_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(test_name, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'cached_test_names': sorted(self._entries),
+            }
@@ -0,0 +1,97 @@
+"""Row generators and encoders for the score exports.
+
+The generators pull rows through server-side cursors so an export never
+holds more than one batch of rows in memory.
+"""
+
+import csv
+import io
+import itertools
+import json
+
+import models
+import resolution
+
+
+FORMATS = {
+    'csv': 'application/xml',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def get_grade(summary, rules=resolution.DEFAULT_RULES):
+    """Grade a submission from its models.ScoreSummary, or None.
+
+    rules decide it as they do for the review page, so a submission waiting
+    for review has no grade.
+    """
+    return resolution.grade(summary, rules)
+
+
+def _in_contest(query, contest_id):
+    if contest_id is None:
+        return query
+    return query.filter(models.Submission.contest_id == contest_id)
+
+
+def final_score_rows(session, contest_id=None,
+                     rules=resolution.DEFAULT_RULES, batch_size=1000):
+    """Yield (email, prob_id, score) for every gradable submission.
+
+    A resolved score wins; otherwise rules grade the submission. With
+    contest_id, only the submissions of that contest.
+    """
+    rows = _in_contest(session.query(
+            models.User.email,
+            models.Submission.prob_id,
+            models.ScoreSummary).select_from(models.User).join(
+                    models.Submission).join(
+                    models.ScoreSummary), contest_id).yield_per(batch_size)
+    for email, pid, summary in rows:
+        if summary.resolved_score is not None:
+            yield email, pid, summary.resolved_score
+            continue
+        grade = get_grade(summary, rules)
+        if grade is not None:
+            yield email, pid, grade
+
+
+def grader_score_rows(session, contest_id=None, batch_size=1000):
+    """Yield (email, grader, prob_id, score) for every score given."""
+    rows = _in_contest(session.query(
+            models.User.email,
+            models.Score.grader,
+            models.Submission.prob_id,
+            models.Score.score).select_from(models.User).join(
+                    models.Submission).join(
+                    models.Score), contest_id).yield_per(batch_size)
+    for row in rows:
+        yield tuple(row)
+
+
+def encode(header, rows, fmt='csv', chunk_rows=500):
+    """Encode rows as csv or ndjson text, one chunk per chunk_rows rows."""
+    if fmt == 'ndjson':
+        for chunk in _chunks(rows, chunk_rows):
+            yield ''.join(json.dumps(dict(zip(header, row))) + '\n'
+                          for row in chunk)
+        return
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(header)
+    for chunk in _chunks(rows, chunk_rows):
+        writer.writerows(chunk)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    if output.tell():  # header of an empty export
+        yield output.getvalue()
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
@@ -1,31 +1,63 @@
 # -*- coding: utf-8 -*-
 
 
-import csv
 from contextlib import contextmanager
 import datetime
-import io
 import json
 import os
+import sys
+import time
+from urllib.parse import urlencode
 import uuid
-from collections import defaultdict
 
-import jinja2
-from jinja2 import Environment, FileSystemLoader
 import bottle
 from bottle import request, response
 import sqlalchemy
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql.expression import func
 
+import admission
+import assignment
+import candidate_state
+import contests
+import dbstats
+import exam_cache
+import exports
+import migrations
 import models
+import previews
+import problem_bank
+import profiling
+import rendering
+import reporting
+import resolution
+import roster
+import score_log
+import score_summary
+import serving
+import static_files
+import translations
+import uploads
 import config
 
 TESTONLY = True
 FILE_SAVE_DIR = '/tmp'
 
-engine = sqlalchemy.create_engine(config.CONN_STRING)
+engine = sqlalchemy.create_engine(
+        config.CONN_STRING, **dbstats.engine_options(config))
+db_monitor = dbstats.PoolMonitor(engine)
+profiler = profiling.Profiler(
+        engine,
+        n_plus_one=getattr(config, 'PROFILE_N_PLUS_ONE', 10),
+        slow_secs=getattr(config, 'PROFILE_SLOW_SECS', 2.0),
+        dump_dir=getattr(config, 'PROFILE_DUMP_DIR', None))
 Session = sqlalchemy.orm.sessionmaker(bind=engine)
-jinja_env = Environment(loader=FileSystemLoader('template'))
+TEMPLATE_PRODUCTION = getattr(config, 'TEMPLATE_PRODUCTION', False)
+jinja_env = rendering.make_environment(
+        'template', production=TEMPLATE_PRODUCTION,
+        cache_dir=getattr(config, 'TEMPLATE_CACHE_DIR', None),
+        template_class=profiler.template_class())
+fragments = rendering.FragmentCache(jinja_env, enabled=TEMPLATE_PRODUCTION)
 
 
 ANSWER_LANG = sorted("""
@@ -42,42 +74,48 @@ Estonian
 """.strip().split('\n'))
 
 
-class I18nManager(object):
+i18n = translations.I18nManager(config.TEXT_STR)
 
-    def __init__(self, csv_path):
-        with open(csv_path) as f:
-            reader = csv.reader(f)
-            self._contents = list(reader)
-            self.all_locales = self._contents[0]
-            self.locales_to_index = {
-                    locale : i for i, locale in enumerate(self.all_locales)}
-            self.name_to_index = {
-                    locale : i for i, locale in enumerate(self._contents[1])}
 
-    def text(self, position, locale):
-        lpos = self.locales_to_index[locale]
-        return self._contents[position - 1][lpos]
+problem_statements = problem_bank.ProblemBank(
+        'problems', check_secs=getattr(config, 'PROBLEM_BANK_CHECK_SECS', 5))
+# locale -> problems/<language>; each round names its <level> file
+PROBLEM_LANGUAGES = getattr(
+        config, 'PROBLEM_LANGUAGES', {'en': 'english', 'es': 'spanish'})
+# translated labels of the first problems of a round
+PROBLEM_LABELS = [93, 95, 106, 112]
 
-    def lang_name(self, locale):
-        if locale == 'ee':
-            return 'Estonian'
-        return self.text(2, locale)
 
-    def locale_name(self, name):
-        return self._contents[0][self.name_to_index[name]]
+def get_problems(language, exam_round):
+    """(label, statement, answer fields) of each problem of exam_round.
 
-
-i18n = I18nManager(config.TEXT_STR)
-
-
-def get_problems(language):
-    prob_indexes = [93, 95, 106, 112, 115]
+    The statement and the answer fields are the same for every candidate,
+    so they come from the fragment cache, keyed by round and locale; a
+    statement is rendered again when its problem file changes.
+    """
+    file_level = exam_round.problem_level
+    bank_language = PROBLEM_LANGUAGES.get(language, 'english')
+    version, statements = problem_statements.versioned(
+            bank_language, file_level)
+    if not statements:
+        bank_language = 'english'
+        version, statements = problem_statements.versioned(
+                bank_language, file_level)
     ans = []
-    for i, j in zip(prob_indexes[:-1], prob_indexes[1:]):
-        label = i18n.text(i, language)
-        # probs = [ i18n.text(x, language) for x in range(i + 1, j) ]
-        probs = [ ]
-        ans.append((label, probs))
+    for n in range(exam_round.num_problems):
+        if n < len(PROBLEM_LABELS):
+            label = i18n.text(PROBLEM_LABELS[n], language)
+        else:
+            label = str(n + 1)
+        statement = fragments.render(
+                'fragments/problem_statement.html', language,
+                key=(exam_round.uid, n), version=(bank_language, version),
+                statement=statements[n].html if n < len(statements) else '')
+        fields = fragments.render(
+                'fragments/answer_fields.html', language,
+                key=(exam_round.uid, n), i18n=i18n,
+                prob_id=exam_round.first_prob_id + n, index=n + 1)
+        ans.append((label, statement, fields))
     return ans
 
 def is_test():
@@ -88,11 +126,26 @@ def is_test():
         return False
 
 
+def current_route():
+    try:
+        return request.route.rule
+    except (RuntimeError, KeyError):
+        return 'cli'
+
+
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
+    started = time.time()
     session = Session()
     try:
+        try:
+            # Check the connection out now so the pool wait is measured.
+            session.connection()
+        except sqlalchemy.exc.TimeoutError:
+            db_monitor.record_timeout()
+            raise
+        db_monitor.checkout_wait.observe(time.time() - started)
         yield session
         session.commit()
     except:
@@ -100,37 +153,109 @@ def session_scope():
         raise
     finally:
         session.close()
+        db_monitor.transactions.observe(
+                current_route(), time.time() - started)
+
+
+def load_active_papers(test_name):
+    with session_scope() as session:
+        papers = session.query(models.ExamPaper).filter_by(
+                is_active=True, test_name=test_name)
+        return [exam_cache.ExamPaperRow(
+                    p.uid, p.test_name, p.language, p.link, p.is_active)
+                for p in papers]
+
+
+exam_papers = exam_cache.ExamPaperCache(
+        load_active_papers,
+        ttl_secs=getattr(config, 'EXAM_CACHE_TTL_SECS', 30))
 
 
 @bottle.get('/static/<path:path>')
 def static(path):
-    return bottle.static_file(path, root='static')
+    return static_files.serve(path, 'static')
+
+
+def submission_file(path):
+    return static_files.serve(
+            path, config.FILE_SAVE_DIR, content_addressed=True,
+            inline_types=static_files.INLINE_UPLOAD_TYPES)
+
+
+# Links are STATIC_FILE_URL/<blob>; serve them here unless they point to
+# another host.
+if '://' not in config.STATIC_FILE_URL:
+    bottle.get('/{}/<path:path>'.format(
+            config.STATIC_FILE_URL.strip('/')))(submission_file)
 
 
 def index():
     return bottle.static_file('mock.html', root='static')
 
-@bottle.get('/user/<uid>')
-def get_landing_page(uid):
+def load_contests():
     with session_scope() as session:
-        user = session.query(models.User).filter_by(access_uuid=uid).first()
+        return contests.load(session)
+
+
+contest_registry = contests.ContestRegistry(
+        load_contests, ttl_secs=getattr(config, 'CONTEST_CACHE_TTL_SECS', 30))
+
+
+def load_candidate(access_uuid):
+    with session_scope() as session:
+        user = session.query(
+                models.User.uid, models.User.contest_id).filter_by(
+                    access_uuid=access_uuid).first()
         if user is None:
-            return 'Access Id not found'
-        enable_day1 = session.query(models.ExamPaper).filter_by(
-                is_active=True, test_name='hard_day_1').first() is not None
-        enable_day2 = session.query(models.ExamPaper).filter_by(
-                is_active=True, test_name='hard_day_2').first() is not None
+            return None
+        starts = session.query(
+                models.RoundStart.round_id, models.RoundStart.started).filter_by(
+                    user_id=user.uid)
+        submitted = session.query(models.Submission.prob_id).filter_by(
+                user_id=user.uid)
+        return candidate_state.CandidateState(
+                user.uid, access_uuid, user.contest_id, dict(starts),
+                frozenset(pid for pid, in submitted))
+
+
+def set_start_time(user_id, round_id, now):
+    """Record now as the start of round_id unless it has one already.
+
+    Returns the start the round ends up with.
+    """
+    try:
+        with session_scope() as session:
+            session.add(models.RoundStart(
+                    user_id=user_id, round_id=round_id, started=now))
+        return now
+    except sqlalchemy.exc.IntegrityError:
+        pass  # a concurrent request started it first
+    with session_scope() as session:
+        return session.query(models.RoundStart.started).filter_by(
+                user_id=user_id, round_id=round_id).scalar()
+
+
+candidates = candidate_state.CandidateCache(
+        load_candidate, set_start_time,
+        ttl_secs=getattr(config, 'CANDIDATE_CACHE_TTL_SECS', 60))
+
+
+@bottle.get('/user/<uid>')
+def get_landing_page(uid):
+    user = candidates.get(uid)
+    if user is None:
+        return 'Access Id not found'
+    rounds = [(exam_round, exam_papers.is_active(exam_round.test_name))
+              for exam_round in contest_registry.rounds(user.contest_id)]
     return jinja_env.get_template('landing.html').render(
-            uid=uid, enable_day1=enable_day1, enable_day2=enable_day2)
+            uid=uid, rounds=rounds)
 
 
 @bottle.get('/user/<uid>/prob_router')
 def route(uid):
-    s = request.query.get('submit')
-    if s == 'Start Day 1':
-        bottle.redirect('/user/{}/prob/jiwls'.format(uid))
-    if s == 'Start Day 2':
-        bottle.redirect('/user/{}/prob/oweiur'.format(uid))
+    exam_round = contest_registry.by_slug(request.query.get('round', ''))
+    if exam_round is not None:
+        bottle.redirect('/user/{}/prob/{}'.format(uid, exam_round.slug))
 
 
 @bottle.get('/user/<uid>/prob/<pid>')
@@ -138,12 +263,8 @@ def get_prob_page(uid, pid):
     msg = request.query.get('msg', '')
     language = request.query.get('lang', 'en')
 
-    level = {
-            'jiwls': 'hard_day_1',
-            'oweiur': 'hard_day_2',
-            }.get(pid)
-
-    if not level:
+    exam_round = contest_registry.by_slug(pid)
+    if exam_round is None:
         return 'Exam not started yet'
 
 
@@ -152,102 +273,250 @@ def get_prob_page(uid, pid):
         if passcode != 'soy un arrecho':
             return 'Exam not started yet'
 
+    # A redirect back from an upload carries msg; reload the submitted set
+    # in case another worker handled the upload.
+    user = candidates.get(uid, refresh=bool(msg))
+    if user is None:
+        return 'Access Id not found'
+    if user.contest_id != exam_round.contest_id:
+        return 'Exam not started yet'
+
+    if is_test():
+        start_time = datetime.datetime.utcnow()
+    else:
+        start_time = candidates.start_time(
+                user, exam_round.uid,
+                datetime.datetime.utcnow().replace(microsecond=0))
+
+    statements = exam_papers.active_papers(exam_round.test_name)
+    if not statements:
+        return 'Exam not started yet'
+
+    print([(s.language, s.is_active) for s in statements])
+    problems = get_problems(language, exam_round)
+    end_time = start_time + datetime.timedelta(
+            minutes=exam_round.duration_mins)
+    current_time = datetime.datetime.utcnow()
+    budget_secs = (end_time - current_time).total_seconds()
+    start_number = exam_round.first_prob_id - 1
+    return jinja_env.get_template('problems.html').render(
+            user=user, msg=msg, problems=problems,
+            lang=language,
+            answer_lang=ANSWER_LANG,
+            end_time=end_time, i18n=i18n, budget_secs=budget_secs,
+            submissions_numbers=user.submitted,
+            statements=statements,
+            start_number=start_number,
+            time_start_utc='{}:{}:{}'.format(
+                start_time.hour, start_time.minute, start_time.second))
+
+def load_ungraded(prob_id, language):
     with session_scope() as session:
-        user = session.query(models.User).filter_by(access_uuid=uid).first()
-        if user is None:
-            return 'Access Id not found'
+        rows = session.query(models.Submission.uid).outerjoin(
+                models.Score).filter(
+                models.Submission.prob_id == prob_id).filter(
+                models.Submission.language == language).filter(
+                models.Score.uid.is_(None))
+        return [uid for uid, in rows]
 
-        submissions_numbers = {s.prob_id for s in user.submissions}
 
-        if is_test():
-            start_time = datetime.datetime.utcnow()
-        else:
-            if level == 'hard_day_1':
-                if user.start_timestamp is None:
-                    start_time = datetime.datetime.utcnow()
-                    session.query(models.User).filter_by(access_uuid=uid).update(
-                            {'start_timestamp': datetime.datetime.utcnow()})
-                else:
-                    start_time = user.start_timestamp
+GRADING_LEASE_SECS = getattr(config, 'GRADING_LEASE_SECS', 30 * 60)
+grading_queue = assignment.GradingQueue(
+        load_ungraded, lease_secs=GRADING_LEASE_SECS,
+        reload_secs=getattr(config, 'GRADING_RELOAD_SECS', 1))
+
+
+def load_queue_counts(prob_id, language):
+    with session_scope() as session:
+        return assignment.claim_counts(
+                session, prob_id, language, datetime.datetime.utcnow())
+
+
+# Shared by every worker through the claims; cached briefly per worker.
+queue_counts_cache = assignment.QueueCounts(
+        load_queue_counts, ttl_secs=getattr(config, 'QUEUE_COUNTS_SECS', 2))
+
+
+def round_starts(session, solutions):
+    """submission uid -> when its author began the problem's round."""
+    rounds = {s.uid: contest_registry.for_prob_id(s.prob_id)
+              for s in solutions}
+    started = {(user_id, round_id): value
+               for user_id, round_id, value in session.query(
+                   models.RoundStart.user_id, models.RoundStart.round_id,
+                   models.RoundStart.started).filter(
+                       models.RoundStart.user_id.in_(
+                           {s.user_id for s in solutions}))}
+    return {s.uid: rounds[s.uid] and started.get(
+                (s.user_id, rounds[s.uid].uid))
+            for s in solutions}
+
+
+def submission_info(solution, st):
+    preview = solution.preview
+    if preview is not None and (preview.source_link != solution.link
+                                or preview.error):
+        preview = None
+    return {
+        'link': solution.link,
+        'prob_id': solution.prob_id,
+        'lang': solution.language,
+        'scores_count': 0,
+        'submission_id': solution.uid,
+        'timestamp': solution.timestamp.isoformat(),
+        'start_time': st.isoformat() if st else 'None',
+        'preview_link': preview.preview_link if preview else None,
+        'page_count': preview.page_count if preview else None,
+        'size': preview.size if preview else None,
+    }
+
+
+def lease_submissions(prob_id, lang, grader, count):
+    """Lease up to count submissions to grader; returns their info dicts.
+
+    The local queue proposes submissions and the claim on each submission
+    row decides, so two worker processes never lease one twice.
+    """
+    while True:
+        sids = grading_queue.acquire_batch(prob_id, lang, grader, count)
+        if not sids:
+            return []
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        with session_scope() as session:
+            solutions = {s.uid: s for s in session.query(
+                    models.Submission).options(
+                        selectinload(models.Submission.preview)).filter(
+                            models.Submission.uid.in_(sids))}
+            scored = {sid for sid, in session.query(
+                    models.Score.submission_id).filter(
+                        models.Score.submission_id.in_(sids))}
+            # The queue may be stale if another process scored or edited it.
+            stale = [sid for sid in sids
+                     if sid not in solutions or sid in scored
+                     or solutions[sid].prob_id != prob_id
+                     or solutions[sid].language != lang]
+            fresh = [sid for sid in sids if sid not in stale]
+            won = assignment.claim(
+                    session, fresh, grader, now, GRADING_LEASE_SECS)
+            lost = assignment.holders(
+                    session, [sid for sid in fresh if sid not in won])
+            if not stale and not lost:
+                starts = round_starts(session, list(solutions.values()))
+                return [submission_info(solutions[sid], starts[sid])
+                        for sid in sids]
+        for sid in stale:
+            grading_queue.discard(sid)
+        for sid, holder, expires in lost:
+            if expires is None:
+                # Scored, though the score may still be in a score log.
+                grading_queue.complete(sid)
             else:
-                if user.day2_timestamp is None:
-                    start_time = datetime.datetime.utcnow()
-                    session.query(models.User).filter_by(access_uuid=uid).update(
-                            {'day2_timestamp': datetime.datetime.utcnow()})
-                else:
-                    start_time = user.day2_timestamp
-
-        statements = session.query(models.ExamPaper).filter_by(
-                is_active=True, test_name=level).all()
-        if not statements:
-            return 'Exam not started yet'
+                grading_queue.hold(
+                        sid, holder, (expires - now).total_seconds())
+
+
+def grading_key():
+    """(prob_id, lang) from the query string, or None if either is bad."""
+    lang = request.query.get('lang')
+    try:
+        prob_id = int(request.query.get('prob_id'))
+    except (TypeError, ValueError):
+        return None
+    if lang is None:
+        return None
+    return prob_id, lang
 
-        print([(s.language, s.is_active) for s in statements])
-        problems = get_problems(language)
-        end_time = start_time + datetime.timedelta(hours=5)
-        current_time = datetime.datetime.utcnow()
-        budget_secs = (end_time - current_time).total_seconds()
-        start_number = 100 if level == 'hard_day_1' else 104
-        return jinja_env.get_template('problems.html').render(
-                user=user, msg=msg, problems=problems,
-                lang=language,
-                answer_lang=ANSWER_LANG,
-                end_time=end_time, i18n=i18n, budget_secs=budget_secs,
-                submissions_numbers=submissions_numbers,
-                statements=statements,
-                start_number=start_number,
-                time_start_utc='{}:{}:{}'.format(
-                    start_time.hour, start_time.minute, start_time.second))
 
 @bottle.get('/submission')
 def get_prob():
-    lang = request.query.get('lang')
-    prob_id = request.query.get('prob_id')
+    key = grading_key()
+    if key is None:
+        return {'status': 'miss argument'}
     grader = request.query.get('not_graded_by')
-    if lang is None or prob_id is None:
+    found = lease_submissions(key[0], key[1], grader, 1)
+    if not found:
+        return {'status': 'not_found'}
+    found[0]['status'] = 'found'
+    return found[0]
+
+
+GRADING_BATCH_MAX = getattr(config, 'GRADING_BATCH_MAX', 20)
+
+
+def queue_counts(key):
+    """Counts of key as JSON, or a 304 if the client has these counts."""
+    counts = queue_counts_cache.get(*key)
+    # Made of the counts alone, so every worker gives the same ETag.
+    etag = '"{}-{}-{}-{}"'.format(
+            counts['waiting'], counts['leased'], *key)
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'no-cache')
+    if request.headers.get('If-None-Match') == etag:
+        raise bottle.HTTPResponse(status=304, headers={
+            'ETag': etag, 'Cache-Control': 'no-cache'})
+    return counts
+
+
+@bottle.get('/api/grading/queue')
+def api_grading_queue():
+    """Queue depth of one (prob_id, lang); supports If-None-Match."""
+    key = grading_key()
+    if key is None:
         return {'status': 'miss argument'}
-    with session_scope() as session:
+    counts = queue_counts(key)
+    counts.update(status='success', prob_id=key[0], lang=key[1])
+    return counts
 
-        graded_by_this = {
-            s.submission_id for s in 
-            session.query(models.Score).filter_by(grader=grader)}
 
-        c_solution = session.query(func.count(models.Score.uid), 
-                models.Submission).outerjoin(models.Score).filter(
-                models.Submission.prob_id == prob_id).filter(
-                models.Submission.language == lang
-                ).group_by(
-                        models.Submission.uid).having(
-                                func.count(models.Score.uid) < 1)
-
-        c, solution = None, None
-        c_solution = sorted(c_solution, key=lambda x: x[0] or 0)
-        for c_sol in c_solution:
-            if c_sol[1].uid not in graded_by_this:
-                c, solution = c_sol
-                break
-        if solution is None:
-            return {'status': 'not_found'}
-        st = (solution.user.start_timestamp if
-              solution.prob_id < 105 else
-              solution.user.day2_timestamp)
-        return {
-            'status': 'found',
-            'link': solution.link,
-            'prob_id': solution.prob_id,
-            'lang': solution.language,
-            'scores_count': c or 0,
-            'submission_id': solution.uid,
-            'timestamp': solution.timestamp.isoformat(),
-            'start_time': st.isoformat() if st else 'None'
-        }
+@bottle.get('/api/grading/next')
+def api_grading_next():
+    """Lease the next count submissions to grader in one call."""
+    key = grading_key()
+    grader = request.query.get('grader')
+    if key is None or not grader:
+        return {'status': 'miss argument'}
+    try:
+        count = int(request.query.get('count', 1))
+    except ValueError:
+        return {'status': 'miss argument'}
+    count = max(1, min(count, GRADING_BATCH_MAX))
+    found = lease_submissions(key[0], key[1], grader, count)
+    queue_counts_cache.invalidate(*key)
+    counts = queue_counts_cache.get(*key)
+    return {
+        'status': 'found' if found else 'not_found',
+        'submissions': found,
+        'queue': counts,
+    }
 
 
 @bottle.post('/submission/<uid>/score')
 def create_score(uid):
     score_prop = json.loads(request.body.read())
     print(score_prop)
+    if score_writer is not None:
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        # Until the logged score is stored, the grader's claim keeps other
+        # workers from leasing the submission. The lease taken here usually
+        # is that claim; a minute to spare leaves time to store the log.
+        if not grading_queue.holds(int(uid), score_prop['grader'], 60):
+            with session_scope() as session:
+                if session.query(models.Submission).get(int(uid)) is None:
+                    return {'status': 'not_found'}
+                assignment.claim(session, [int(uid)], score_prop['grader'],
+                                 now, GRADING_LEASE_SECS)
+        score_writer.append({
+            'submission_id': int(uid),
+            'comment': score_prop['comment'],
+            'grader': score_prop['grader'],
+            'score': score_prop['score'],
+            'timestamp': now,
+        })
+        grading_queue.complete(int(uid))
+        return {'status': 'success'}
     with session_scope() as session:
+        if session.query(models.Submission).get(int(uid)) is None:
+            return {'status': 'not_found'}
         new_score = models.Score()
         new_score.submission_id = uid
         new_score.comment = score_prop['comment']
@@ -255,10 +524,49 @@ def create_score(uid):
         new_score.score = score_prop['score']
         new_score.timestamp = datetime.datetime.utcnow()
         session.add(new_score)
+        score_summary.record_score(session, int(uid), new_score.score)
+        resolution.drop_automatic(session, [int(uid)])
+        assignment.mark_scored(session, [int(uid)])
         session.commit()
+    grading_queue.complete(int(uid))
     return {'status': 'success'}
 
 
+def store_logged_scores(records):
+    """Insert a batch of logged scores, skipping any stored before.
+
+    Returns the scores of submissions that no longer exist, unstored.
+    """
+    with session_scope() as session:
+        known = {uid for uid, in session.query(models.Submission.uid).filter(
+                models.Submission.uid.in_(
+                    {r['submission_id'] for r in records}))}
+        stored = {log_id for log_id, in session.query(
+                models.Score.log_id).filter(
+                    models.Score.log_id.in_({r['log_id'] for r in records}))}
+        new = [r for r in records if r['log_id'] not in stored
+               and r['submission_id'] in known]
+        if new:
+            session.execute(models.Score.__table__.insert(), new)
+            for r in new:
+                score_summary.record_score(
+                        session, r['submission_id'], r['score'])
+            resolution.drop_automatic(
+                    session, {r['submission_id'] for r in new})
+            assignment.mark_scored(
+                    session, {r['submission_id'] for r in new})
+    return [r for r in records if r['submission_id'] not in known]
+
+
+# Set SCORE_WAL_DIR to acknowledge scores once they are in a local log and
+# store them in batches every SCORE_FLUSH_SECS.
+score_writer = None
+if getattr(config, 'SCORE_WAL_DIR', None):
+    score_writer = score_log.ScoreLog(
+            config.SCORE_WAL_DIR, store_logged_scores,
+            interval_secs=getattr(config, 'SCORE_FLUSH_SECS', 1.0))
+
+
 @bottle.post('/upload_solution/<uid>')
 def recv_solution(uid):
     prob_id = int(request.forms.get('prob_id'))
@@ -267,165 +575,347 @@ def recv_solution(uid):
     upload = request.files.get('upload', None)
     language = request.forms.get('language')
     timestamp = datetime.datetime.utcnow()
-    level = 'jiwls' if prob_id <= 104 else 'oweiur'
+    exam_round = contest_registry.for_prob_id(prob_id)
+    if exam_round is None:
+        return 'Unknown problem'
+    # Only the candidate's own rounds take uploads, as on the problem page.
+    user = candidates.get(uid)
+    if user is None or user.uid != user_id:
+        return 'Access Id not found'
+    if user.contest_id != exam_round.contest_id:
+        return 'Unknown problem'
+    redirect_url = '/user/{}/prob/{}?msg=success'.format(uid, exam_round.slug)
     with session_scope() as session:
-        prev_submission = session.query(models.Submission).filter_by(
+        prev_submission = session.query(models.Submission.uid).filter_by(
                 user_id=user_id, prob_id=prob_id).first()
 
-        redirect_url = '/user/{}/prob/{}?msg=success'.format(uid, level)
-        if prev_submission:
-            filename = os.path.basename(prev_submission.link)
-            upload.save(os.path.join(config.FILE_SAVE_DIR, filename),
-                        overwrite=True)
+    # The file goes to disk before any transaction is opened.
+    stored = None
+    if upload is not None:
+        if link and not prev_submission:
+            bottle.redirect(
+                ('/user/{}/prob?msg=cannot+'
+                'upload+file+and+link+at+the+same+time').format(uid))
+        orig_name, ext = os.path.splitext(upload.filename)
+        blob, stored = uploads.store_blob(
+                upload.file, config.FILE_SAVE_DIR, ext)
+        link = os.path.join(config.STATIC_FILE_URL, blob)
+        profiler.record_phase('io', stored.seconds)
+
+    new_key = None
+    if not prev_submission:
+        try:
+            with session_scope() as session:
+                sub = models.Submission()
+                sub.link = link
+                sub.contest_id = exam_round.contest_id
+                sub.user_id = user_id
+                sub.prob_id = prob_id
+                sub.language = language
+                sub.timestamp = timestamp
+                session.add(sub)
+                session.flush()
+                score_summary.create(session, sub.uid)
+                new_key = (sub.prob_id, sub.language, sub.uid)
+        except sqlalchemy.exc.IntegrityError:
+            pass  # a concurrent upload created it first; update that one
+    if new_key is None:
+        changes = {'timestamp': timestamp}
+        if stored is not None:
+            changes['link'] = link
+        with session_scope() as session:
             session.query(models.Submission).filter_by(
-                    uid=prev_submission.uid).update(
-                            {'timestamp': timestamp})
-            session.commit()
-        else:
-            if upload is not None:
-                if link:
-                    bottle.redirect(
-                        ('/user/{}/prob?msg=cannot+'
-                        'upload+file+and+link+at+the+same+time').format(uid))
-                orig_name, ext = os.path.splitext(upload.filename)
-                new_filename = uuid.uuid4().hex + ext
-                upload.save(os.path.join(config.FILE_SAVE_DIR, new_filename))
-                link = os.path.join(config.STATIC_FILE_URL, new_filename)
-            sub = models.Submission()
-            sub.link = link
-            sub.user_id = user_id
-            sub.prob_id = prob_id
-            sub.language = language
-            sub.timestamp = timestamp
-            session.add(sub)
-            session.commit()
-        return bottle.redirect(redirect_url)
+                    user_id=user_id, prob_id=prob_id).update(changes)
+    else:
+        grading_queue.add(*new_key)
+    candidates.add_submission(uid, prob_id)
+    if stored is not None and PREVIEW_WORKERS:
+        preview_jobs.notify()
+    return bottle.redirect(redirect_url)
+
+
+PREVIEW_MAX_ATTEMPTS = getattr(config, 'PREVIEW_MAX_ATTEMPTS', 5)
+PREVIEW_RETRY_SECS = getattr(config, 'PREVIEW_RETRY_SECS', 60)
+
+
+def load_preview_jobs(limit):
+    """Submissions whose local file has no up-to-date preview yet."""
+    prefix = config.STATIC_FILE_URL.rstrip('/') + '/'
+    sub, preview = models.Submission, models.SubmissionPreview
+    with session_scope() as session:
+        rows = session.query(sub.uid, sub.link).outerjoin(preview).filter(
+                sub.link.like(prefix + '%'),
+                sqlalchemy.or_(
+                    preview.submission_id.is_(None),
+                    preview.source_link != sub.link,
+                    sqlalchemy.and_(
+                        preview.error.isnot(None),
+                        preview.attempts < PREVIEW_MAX_ATTEMPTS,
+                        preview.next_attempt <= datetime.datetime.utcnow()))
+                ).order_by(sub.uid).limit(limit)
+        return [(sid, link, os.path.join(
+                    config.FILE_SAVE_DIR, link[len(prefix):]))
+                for sid, link in rows]
+
+
+def record_preview(sid, link, result=None, error=None):
+    now = datetime.datetime.utcnow()
+    with session_scope() as session:
+        row = session.query(models.SubmissionPreview).get(sid)
+        if row is None:
+            row = models.SubmissionPreview(submission_id=sid)
+            session.add(row)
+        if row.source_link != link:
+            row.attempts = 0
+        row.source_link = link
+        row.updated = now
+        row.attempts = (row.attempts or 0) + 1
+        if error is not None:
+            row.error = error
+            row.next_attempt = now + datetime.timedelta(
+                    seconds=PREVIEW_RETRY_SECS * 2 ** (row.attempts - 1))
+            return
+        row.error = row.next_attempt = None
+        row.content_type = result['content_type']
+        row.page_count = result['page_count']
+        row.size = result['size']
+        row.sha256 = result['sha256']
+        row.preview_link = result['preview'] and os.path.join(
+                PREVIEW_URL, result['preview'])
+
+
+PREVIEW_SAVE_DIR = getattr(config, 'PREVIEW_SAVE_DIR',
+                           os.path.join(config.FILE_SAVE_DIR, 'previews'))
+PREVIEW_URL = getattr(config, 'PREVIEW_URL',
+                      os.path.join(config.STATIC_FILE_URL, 'previews'))
+# Set PREVIEW_WORKERS to 0 to turn previews off.
+PREVIEW_WORKERS = getattr(config, 'PREVIEW_WORKERS', 2)
+preview_jobs = previews.PreviewQueue(
+        load_preview_jobs, record_preview, PREVIEW_SAVE_DIR,
+        os.path.join(PREVIEW_SAVE_DIR, '.dispatcher.lock'),
+        workers=PREVIEW_WORKERS,
+        max_px=getattr(config, 'PREVIEW_MAX_PX', 1600))
+
+
+ADMIN_PAGE_SIZE = getattr(config, 'ADMIN_PAGE_SIZE', 100)
+
+
+# ?contest=all (--contest all) picks every contest; it is never a fallback.
+ALL_CONTESTS = 'all'
+
+
+def selected_contest_id():
+    """uid of the contest named by ?contest=, else of the current one.
+
+    None for ?contest=all. An unknown name, or no name while no contest is
+    active, is an HTTP error rather than every contest.
+    """
+    name = request.query.get('contest')
+    if name == ALL_CONTESTS:
+        return None
+    contest = (contest_registry.contest(name) if name
+               else contest_registry.current())
+    if contest is None and name:
+        raise bottle.HTTPError(404, 'No contest named {}.'.format(name))
+    if contest is None:
+        raise bottle.HTTPError(400, 'No contest is active; pass '
+                               '?contest=<name> or ?contest=all.')
+    return contest.uid
+
+
+def submission_filters():
+    """contest, prob_id, language and grader filters from the query string.
+
+    The contest defaults to the current one; contest=all lists them all.
+    """
+    filters = {}
+    for key in ('contest', 'prob_id', 'language', 'grader'):
+        value = request.query.get(key)
+        if value:
+            filters[key] = value
+    if 'contest' not in filters and contest_registry.current() is not None:
+        filters['contest'] = contest_registry.current().name
+    if 'prob_id' in filters:
+        try:
+            filters['prob_id'] = int(filters['prob_id'])
+        except ValueError:
+            del filters['prob_id']
+    return filters
+
+
+def filter_submissions(query, filters):
+    if filters.get('contest', ALL_CONTESTS) != ALL_CONTESTS:
+        contest = contest_registry.contest(filters['contest'])
+        if contest is None:
+            return query.filter(sqlalchemy.false())
+        query = query.filter(models.Submission.contest_id == contest.uid)
+    if 'prob_id' in filters:
+        query = query.filter(models.Submission.prob_id == filters['prob_id'])
+    if 'language' in filters:
+        query = query.filter(models.Submission.language == filters['language'])
+    if 'grader' in filters:
+        graded = query.session.query(models.Score.submission_id).filter(
+                models.Score.grader == filters['grader'])
+        query = query.filter(models.Submission.uid.in_(graded))
+    return query
+
+
+def paginate(query, filters):
+    """Apply the requested page to query; returns (rows, pager)."""
+    try:
+        page = max(1, int(request.query.get('page', 1)))
+    except ValueError:
+        page = 1
+    total = query.order_by(None).count()
+    rows = query.limit(ADMIN_PAGE_SIZE).offset(
+            (page - 1) * ADMIN_PAGE_SIZE).all()
+    pager = {
+        'page': page,
+        'num_pages': max(1, -(-total // ADMIN_PAGE_SIZE)),
+        'total': total,
+        'filters': filters,
+        'query': urlencode(filters),
+    }
+    return rows, pager
+
+
+REPORTING_DB = getattr(config, 'REPORTING_DB', None)
+reports = (reporting.ReportSnapshot(
+               engine, REPORTING_DB,
+               refresh_secs=getattr(config, 'REPORTING_REFRESH_SECS', 60))
+           if REPORTING_DB else None)
+
+
+@contextmanager
+def report_scope():
+    """(session, snapshot info) for the admin reports.
+
+    The session reads the reporting snapshot once there is one; until
+    then, or with REPORTING_DB unset, it is a live session and the info
+    is None. A stale snapshot is rebuilt in the background.
+    """
+    snapshot = reports and reports.info(refresh_stale=True)
+    if snapshot is None:
+        with session_scope() as session:
+            yield session, None
+    else:
+        with reports.session() as session:
+            yield session, snapshot
+
+
+@bottle.post('/supersecreteurl/snapshot/refresh')
+def refresh_snapshot():
+    if reports is None:
+        return bottle.HTTPError(404, 'REPORTING_DB is not set.')
+    reports.refresh_later(since=time.time())
+    bottle.redirect(request.get_header('Referer')
+                    or '/supersecreteurl/stats')
 
 
 @bottle.get('/supersecreteurl/nadielosabra/asjfsadjflsdjl')
 def all_solutions():
-    with session_scope() as session:
-        scores = dict(session.query(
-                models.Score.submission_id,
-                func.count(models.Score.uid)).group_by(
-                        models.Score.submission_id))
-        submissions = sorted(
-                session.query(models.Submission, models.User).filter(
-                models.Submission.user_id == models.User.uid),
-                key=lambda x: scores.get(x[0].uid, 0))
+    filters = submission_filters()
+    num_scores = func.coalesce(models.ScoreSummary.num_scores, 0)
+    with report_scope() as (session, snapshot):
+        query = session.query(
+                models.Submission, models.User, num_scores).join(
+                models.User,
+                models.Submission.user_id == models.User.uid).outerjoin(
+                models.ScoreSummary)
+        query = filter_submissions(query, filters).order_by(
+                num_scores, models.Submission.uid)
+        submissions, pager = paginate(query, filters)
         return jinja_env.get_template('submissions.html'
-            ).render(submissions=submissions, scores=scores)
+            ).render(submissions=submissions, pager=pager, snapshot=snapshot)
+
+RESOLUTION_RULES = getattr(config, 'RESOLUTION_RULES', resolution.DEFAULT_RULES)
+
 
 @bottle.get('/supersecreteurl/vitafusion/scores')
 def all_scores():
-    with session_scope() as session:
-        submissions_scores = session.query(models.Submission, models.Score).filter(
-                models.Submission.uid == models.Score.submission_id).all()
-        grouped = defaultdict(list)
-        for sub, score in submissions_scores:
-            grouped[sub.uid].append((sub, score))
-
-        def diff_score(sub_score_list):
-            scores = list(map(lambda x: x[1].score, sub_score_list))
-            return -(max(scores) - min(scores))
-
-        def should_keep_review(submission):
-            # submission is list of tuple of (submission, score)
-            num_scores = len(submission)
-            scores = [s[1].score for s in submission if s[1].score != -1]
-            if not scores:  # score is empty i.e. all -1
-                return True
-#            if num_scores <= 1:
-#                return True
-#            if max(scores) - min(scores) > 2:
-#                return True
-#            if max(scores) == 7:
-#                if min(scores) != 7:
-#                    return True
-#                if num_scores < 2:
-#                    return True
-            return False
-
-        filtered = filter(should_keep_review, grouped.values())
-        sorted_grouped = sorted(filtered, key=diff_score)
+    filters = submission_filters()
+    summary = models.ScoreSummary
+    with report_scope() as (session, snapshot):
+        # RESOLUTION_RULES decides what needs review; see resolution.py.
+        query = session.query(models.Submission).join(summary).filter(
+                resolution.review_clause(RESOLUTION_RULES)).options(
+                selectinload(models.Submission.scores),
+                selectinload(models.Submission.resolved_score))
+        query = filter_submissions(query, filters).order_by(
+                (summary.max_score - summary.min_score).desc(),
+                models.Submission.uid)
+        to_review, pager = paginate(query, filters)
+        sorted_grouped = [[(sub, score) for score in sub.scores]
+                          for sub in to_review]
         return jinja_env.get_template('resolve_score.html'
-            ).render(submissions=sorted_grouped)
+            ).render(submissions=sorted_grouped, pager=pager,
+                     snapshot=snapshot)
+
+
+def resolve_all_scores(contest_id=None):
+    """Write the automatic grade of every submission; returns stats.
+
+    With contest_id, only the submissions of that contest.
+    """
+    started = time.time()
+    with session_scope() as session:
+        result = resolution.resolve(
+                session, RESOLUTION_RULES, contest_id=contest_id)
+        resolved_secs = time.time() - started
+        written = resolution.write(session, result, contest_id=contest_id)
+    return {
+        'submissions': len(result.grades),
+        'resolved': written,
+        'review': len(result.review),
+        'resolve_secs': round(resolved_secs, 6),
+        'total_secs': round(time.time() - started, 6),
+    }
+
+
+@bottle.post('/supersecreteurl/vitafusion/resolve')
+def route_resolve_scores():
+    return resolve_all_scores(selected_contest_id())
+
+
+def stream_export(header, row_source, fmt):
+    with report_scope() as (session, _):
+        for chunk in exports.encode(
+                header, row_source(session), fmt,
+                chunk_rows=getattr(config, 'EXPORT_CHUNK_ROWS', 500)):
+            yield chunk
+
+
+def export_response(header, row_source):
+    disp = request.query.get('disp')
+    fmt = request.query.get('format', 'csv')
+    if fmt not in exports.FORMATS:
+        return 'Unknown format {}'.format(fmt)
+    if not disp:
+        response.set_header('Content-disposition', 'attachment')
+        response.set_header('Content-type', exports.FORMATS[fmt])
+    snapshot = reports and reports.info()
+    if snapshot is not None:
+        response.set_header('X-Snapshot-Taken',
+                            snapshot['taken_at'].isoformat() + 'Z')
+    return stream_export(header, row_source, fmt)
+
 
 @bottle.get('/supersecreteurl/vitafusion/scores.csv')
 def all_scores_csv():
-    disp = request.query.get('disp')
-    with session_scope() as session:
-        user_submissions = session.query(
-                models.User.email,
-                models.Submission.uid,
-                models.Submission.prob_id, 
-                models.ResolvedScore.score).select_from(models.User).join(
-                        models.Submission).join(
-                        models.ResolvedScore, isouter=True).all()
-        submissions_scores = session.query(
-                models.Submission, models.Score).filter(
-                models.Submission.uid == models.Score.submission_id)
-        grouped = defaultdict(list)
-        for sub, score in submissions_scores:
-            grouped[sub.uid].append((sub, score))
-        def get_grade(submission):
-            # submission is list of tuple of (submission, score)
-            num_scores = len(submission)
-            scores = [s[1].score for s in submission if s[1].score != -1]
-            if not scores:  # score is empty i.e. all -1
-                return None 
-            if num_scores > 1 and len(scores) == 1:
-                return scores[0]
-            return min(scores)
-            if max(scores) - min(scores) == 0:
-                return min(scores)
-            if max(scores) == 7: 
-                return None 
-            if max(scores) - min(scores) == 1:
-                return min(scores)
-            if max(scores) - min(scores) == 2:
-                return min(scores) + 1
-            return None
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['email', 'prob num', 'score'])
-        for user, sid, pid, score in user_submissions:
-            if score is not None:
-                writer.writerow([user, pid, score])
-            else:
-                all_scores = grouped.get(sid)
-                if all_scores is None:
-                    continue
-                newscore = get_grade(all_scores)
-                if newscore is not None:
-                    writer.writerow([user, pid, newscore])
-    
-        if not disp:
-            response.set_header('Content-disposition', 'attachment')
-            response.set_header('Content-type', 'application/xml')
-        return output.getvalue()
+    contest_id = selected_contest_id()
+    return export_response(
+            ['email', 'prob num', 'score'],
+            lambda session: exports.final_score_rows(
+                session, contest_id, RESOLUTION_RULES))
+
 
 @bottle.get('/supersecreteurl/vitafusion/scores2.csv')
 def all_scores_csv2():
-    disp = request.query.get('disp')
-    with session_scope() as session:
-        users = session.query(models.User).all()
-        submissions_scores = session.query(
-                models.Submission, models.Score).filter(
-                models.Submission.uid == models.Score.submission_id)
-        user_id_to_email = {u.uid: u.email for u in users}
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['email', 'grader', 'prob num', 'score'])
-        for sub, scores in submission_scores:
-            email = user_id_to_email[sub.user_id]
-            writer.writerow([email, scores.grader, sub.prob_id, scores.score])
-
-        if not disp:
-            response.set_header('Content-disposition', 'attachment')
-            response.set_header('Content-type', 'application/xml')
-        return output.getvalue()
+    contest_id = selected_contest_id()
+    return export_response(
+            ['email', 'grader', 'prob num', 'score'],
+            lambda session: exports.grader_score_rows(session, contest_id))
+
 
 @bottle.get('/submission/<uid>')
 def edit_submission(uid):
@@ -453,55 +943,54 @@ def save_submission(uid):
                     'language': new_lang,
                     'prob_id': new_prob_id
                     })
+        touched = [sid for sid, in session.query(
+                models.Score.submission_id).filter(
+                models.Score.uid.in_(to_remove))]
         session.query(models.Score).filter(
                 models.Score.uid.in_(to_remove)).delete(
                         synchronize_session='fetch')
+        resolution.drop_automatic(session, touched)
+        score_summary.refresh(session, touched)
+        # It may have moved queues or lost its scores; let it be leased anew.
+        assignment.unclaim(session, [int(uid)])
         session.commit()
-        bottle.redirect('/submission/{}'.format(uid))
+    # Edits move submissions between queues and may unscore them.
+    grading_queue.invalidate()
+    bottle.redirect('/submission/{}'.format(uid))
 
 
 
 
 @bottle.get('/supersecreteurl/gradingpage')
 def grading_page():
-    return jinja_env.get_template('grading.html').render(answer_langs=ANSWER_LANG)
+    problems = sorted(prob_id for exam_round in contest_registry.active_rounds()
+                      for prob_id in contests.prob_ids(exam_round))
+    return jinja_env.get_template('grading.html').render(
+            answer_langs=ANSWER_LANG, problems=problems)
 
 
-def insert_users_from_file(path):
-    with open(path) as f:
-        content = list(f.read().strip().split())
-        with session_scope() as session:
-            users = session.query(models.User).filter(
-                    models.User.email.in_(content))
-            existing = {u.email for u in users}
-            for e in content:
-                if e in existing:
-                    continue
-                u = models.User()
-                u.email = e
-                access = uuid.uuid4().hex
-                u.access_uuid = access
-                session.add(u)
-                print('user', e, access)
-            session.commit()
-
-
-def export_users(path):
-    with open('/home/servidor/hardexam.csv') as x:
-        emails = set(x.read().split())
-    with open(path, 'w', newline='') as f:
-        csv_writer = csv.writer(f)
-        with session_scope() as session:
-            users = session.query(models.User).filter(
-                    models.User.email.in_(emails))
-            for user in users:
-                csv_writer.writerow((user.email, 
-                        'http://exam.gqmo.org/user/{}'.format(
-                            user.access_uuid)))
+def insert_users_from_file(path, batch_size=1000, contest_id=None):
+    with open(path, newline='') as f:
+        roster.import_users(engine, roster.read_emails(f), batch_size,
+                            contest_id=contest_id)
+
+
+def export_users(path, emails_path=None, batch_size=1000, contest_id=None):
+    base_url = getattr(config, 'EXAM_BASE_URL', 'http://exam.gqmo.org')
+    with open(path, 'w', newline='') as out:
+        if not emails_path:
+            roster.export_users(engine, out, base_url, batch_size=batch_size,
+                                contest_id=contest_id)
+            return
+        with open(emails_path, newline='') as f:
+            roster.export_users(engine, out, base_url,
+                                emails=roster.read_emails(f),
+                                batch_size=batch_size, contest_id=contest_id)
 
 @bottle.get('/supersecreteurl/blahblah/problem_links')
 def problem_links():
-    exam_names = ["hard_day_1", "hard_day_2"]
+    exam_names = [exam_round.test_name
+                  for exam_round in contest_registry.active_rounds()]
     with session_scope() as session:
         all_problems = list(session.query(models.ExamPaper))
         return jinja_env.get_template('exam_links.html').render(
@@ -522,6 +1011,7 @@ def new_problem_links():
         exam.test_name = exam_name
         session.add(exam)
         session.commit()
+    exam_papers.invalidate()
     bottle.redirect('/supersecreteurl/blahblah/problem_links')
 
 
@@ -541,10 +1031,33 @@ def save_result(uid):
             new.grader = data['grader']
             new.score = data['score']
             session.add(new)
+        score_summary.set_resolved(session, uid, data['score'])
         session.commit() 
         return {'status': 'success'}
 
 
+@bottle.get('/supersecreteurl/stats')
+def server_stats():
+    return {
+        'exam_cache': exam_papers.stats(),
+        'contests': contest_registry.stats(),
+        'candidates': candidates.stats(),
+        'queue_counts': queue_counts_cache.stats(),
+        'problem_bank': problem_statements.stats(),
+        'previews': preview_jobs.stats(),
+        'uploads': uploads.stats(),
+        'db': db_monitor.stats(),
+        'score_log': score_writer and score_writer.stats(),
+        'admission': admission_control and admission_control.stats(),
+        'reports': reports and reports.stats(),
+    }
+
+
+@bottle.get('/supersecreteurl/profile')
+def route_profile():
+    return profiler.snapshot()
+
+
 @bottle.put('/exam/<uid>')
 def modify_exam(uid):
     content = json.loads(request.body.read())
@@ -553,24 +1066,113 @@ def modify_exam(uid):
         session.query(models.ExamPaper).filter_by(uid=uid).update(
                 content)
         session.commit()
-        return {'status': 'success'}
+    exam_papers.invalidate()
+    return {'status': 'success'}
+
+
+def _blob_names(links, url):
+    prefix = url.rstrip('/') + '/'
+    return {link[len(prefix):] for link, in links
+            if link and link.startswith(prefix)}
 
 
-def make_one_user(email): 
+def collect_file_garbage(dry_run=False):
+    """Delete uploaded files and previews that nothing links to anymore."""
+    with session_scope() as session:
+        files = _blob_names(session.query(models.Submission.link),
+                            config.STATIC_FILE_URL)
+        shown = _blob_names(
+                session.query(models.SubmissionPreview.preview_link),
+                PREVIEW_URL)
+    roots = [(config.FILE_SAVE_DIR, files), (PREVIEW_SAVE_DIR, shown)]
+    if os.path.abspath(PREVIEW_SAVE_DIR) == os.path.abspath(
+            config.FILE_SAVE_DIR):
+        roots = [(config.FILE_SAVE_DIR, files | shown)]
+    for root, referenced in roots:
+        removed, freed = uploads.collect_garbage(
+                root, referenced,
+                grace_secs=getattr(config, 'BLOB_GC_GRACE_SECS', 3600),
+                dry_run=dry_run)
+        print('would remove' if dry_run else 'removed', removed, 'files,',
+              freed, 'bytes from', root)
+
+
+def make_one_user(email, contest_id=None):
     with session_scope() as session:
         user = session.query(models.User).filter(
+                models.User.contest_id == contest_id,
                 models.User.email == email).first()
         if user is not None:
             print('already exists', user.access_uuid)
             return
         user = models.User()
         user.email = email
+        user.contest_id = contest_id
         user.access_uuid = uuid.uuid4().hex
         session.add(user)
         print('created: ', user.access_uuid)
 
 
+def create_contest(path):
+    """Create the contest described by the JSON file at path.
+
+    {"name": ..., "rounds": [{"position": 1, "label": "Day 1", "slug": ...,
+    "test_name": ..., "first_prob_id": ..., "num_problems": ...,
+    "duration_mins": ..., "problem_level": ...}, ...]}
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    with session_scope() as session:
+        uid = contests.create(session, spec['name'], spec['rounds'],
+                              is_active=spec.get('is_active', True))
+    contest_registry.invalidate()
+    print('created contest', spec['name'], uid)
+
+
+def cli_contest(name):
+    """uid of contest name, or of the current contest without a name.
+
+    None for every contest (ALL_CONTESTS) or when no contest is active.
+    """
+    if name == ALL_CONTESTS:
+        return None
+    contest = (contest_registry.contest(name) if name
+               else contest_registry.current())
+    if name and contest is None:
+        raise SystemExit('no contest named {}'.format(name))
+    return contest and contest.uid
+
+
+def make_admission_control():
+    classes = dict(admission.DEFAULT_CLASSES)
+    for name, limits in getattr(config, 'ADMISSION_CLASSES', {}).items():
+        classes[name] = admission.RouteClass(*limits)
+    routes = list(admission.DEFAULT_ROUTES)
+    if '://' not in config.STATIC_FILE_URL:
+        routes.append((None, '/{}/'.format(
+                config.STATIC_FILE_URL.strip('/')), 'files'))
+    return admission.AdmissionController(
+            classes, routes,
+            max_active=getattr(config, 'ADMISSION_MAX_ACTIVE', 32))
+
+
+admission_control = (make_admission_control()
+                     if getattr(config, 'ADMISSION_CONTROL', True) else None)
+
+
+def start_worker():
+    engine.dispose()  # never share the parent's connections
+    if score_writer is not None:
+        score_writer.start()  # also replays logs left by a crash
+    if PREVIEW_WORKERS:
+        preview_jobs.start()
+
+
 application = bottle.default_app()
+if getattr(config, 'PROFILE_REQUESTS', True):
+    application = profiler.middleware(application)
+if admission_control is not None:
+    application = admission_control.middleware(application)
 
 if __name__ == '__main__':
     import argparse
@@ -578,15 +1180,86 @@ if __name__ == '__main__':
     parser.add_argument('--insert_users', default='')
     parser.add_argument('--create_db', default='')
     parser.add_argument('--export_users', default='')
+    parser.add_argument('--export_emails',
+                        default='/home/servidor/hardexam.csv',
+                        help='only export these emails; empty for everyone')
+    parser.add_argument('--batch_size', type=int, default=1000)
     parser.add_argument('--new_user', default='')
+    parser.add_argument('--contest', default='',
+                        help='contest of the users and scores to work on; '
+                             'default is the current one, '
+                             '"{}" is every contest'.format(ALL_CONTESTS))
+    parser.add_argument('--create_contest', default='',
+                        help='JSON file describing a new contest')
+    parser.add_argument('--migrate', action='store_true')
+    parser.add_argument('--rebuild_score_summary', action='store_true')
+    parser.add_argument('--gc_files', action='store_true')
+    parser.add_argument('--dry_run', action='store_true')
+    parser.add_argument('--resolve_scores', action='store_true',
+                        help='write automatic grades with RESOLUTION_RULES; '
+                             'run again once more scores come in')
+    parser.add_argument('--refresh_reports', action='store_true',
+                        help='rebuild the REPORTING_DB snapshot now')
+    parser.add_argument('--precompress_static', action='store_true',
+                        help='write .gz/.br variants of the static assets')
+    parser.add_argument('--serve', default='', choices=['', 'threaded', 'async'],
+                        help='production server; default is bottle.run')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes, default one per CPU')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8099)
     args = parser.parse_args()
     if args.create_db:
         models.Base.metadata.create_all(engine)
     elif args.insert_users:
-        insert_users_from_file(args.insert_users)
+        insert_users_from_file(args.insert_users, args.batch_size,
+                               cli_contest(args.contest))
     elif args.export_users:
-        export_users(args.export_users)
+        export_users(args.export_users, args.export_emails, args.batch_size,
+                     cli_contest(args.contest))
     elif args.new_user:
-        make_one_user(args.new_user)
+        make_one_user(args.new_user, cli_contest(args.contest))
+    elif args.create_contest:
+        create_contest(args.create_contest)
+    elif args.migrate:
+        migrations.add_missing_indexes(engine)
+        with session_scope() as session:
+            # PROBLEM_LEVELS: test name -> level, from before contests
+            contests.adopt_legacy(
+                    session, getattr(config, 'PROBLEM_LEVELS', None))
+            print('added', score_summary.fill_missing(session), 'summaries')
+    elif args.rebuild_score_summary:
+        with session_scope() as session:
+            print('rebuilt', score_summary.rebuild_all(session), 'summaries')
+    elif args.gc_files:
+        collect_file_garbage(dry_run=args.dry_run)
+    elif args.resolve_scores:
+        contest_id = cli_contest(args.contest)
+        if contest_id is None and args.contest != ALL_CONTESTS:
+            raise SystemExit('no contest is active; pass --contest NAME '
+                             'or --contest {}'.format(ALL_CONTESTS))
+        print(resolve_all_scores(contest_id))
+    elif args.refresh_reports:
+        if reports is None:
+            raise SystemExit('REPORTING_DB is not set')
+        reports.refresh()
+        print(reports.stats())
+    elif args.precompress_static:
+        print('wrote', static_files.precompress('static'), 'files')
+    elif args.serve:
+        if args.serve == 'async':
+            try:
+                import gevent.monkey
+            except ImportError:
+                raise SystemExit('--serve async needs gevent installed')
+            if not gevent.monkey.is_module_patched('socket'):
+                # Patch before anything else is imported, then come back.
+                os.execv(sys.executable, [sys.executable, '-m', 'gevent.monkey']
+                         + sys.argv)
+        serving.serve(application, args.host, args.port, mode=args.serve,
+                      workers=args.workers or None,
+                      grace_secs=getattr(config, 'SHUTDOWN_GRACE_SECS', 30),
+                      after_fork=start_worker)
     else:
-        bottle.run(host='0.0.0.0', port=8099)
+        start_worker()
+        bottle.run(app=application, host=args.host, port=args.port)
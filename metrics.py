@@ -0,0 +1,119 @@
+"""Small thread-safe counters shown on the stats endpoint."""
+
+import bisect
+import threading
+import time
+
+
+class Summary(object):
+    """Count, total and extremes of a stream of observed values."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+            }
+
+
+class SummaryGroup(object):
+    """One Summary per key, created on first use."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._summaries = {}
+
+    def observe(self, key, value):
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = Summary()
+        summary.observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            items = list(self._summaries.items())
+        return {key: summary.snapshot() for key, summary in items}
+
+
+class RollingHistogram(object):
+    """Histogram of the values observed in the last window_secs.
+
+    Values fall in geometric buckets from 0.5ms to about a minute;
+    percentiles report the upper bound of their bucket.
+    """
+
+    BOUNDS = tuple(0.0005 * 2 ** (i / 2.0) for i in range(34))
+
+    def __init__(self, window_secs=300, slot_secs=10, clock=time.time):
+        self._slot_secs = slot_secs
+        self._slots_kept = max(1, int(window_secs // slot_secs))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._slots = {}  # slot number -> [bucket counts, count, total, max]
+
+    def _slot(self, now):
+        number = int(now // self._slot_secs)
+        slot = self._slots.get(number)
+        if slot is None:
+            slot = self._slots[number] = [
+                    [0] * (len(self.BOUNDS) + 1), 0, 0.0, 0.0]
+            for old in [n for n in self._slots
+                        if n <= number - self._slots_kept]:
+                del self._slots[old]
+        return slot
+
+    def observe(self, value):
+        with self._lock:
+            slot = self._slot(self._clock())
+            slot[0][bisect.bisect_left(self.BOUNDS, value)] += 1
+            slot[1] += 1
+            slot[2] += value
+            slot[3] = max(slot[3], value)
+
+    def snapshot(self):
+        with self._lock:
+            self._slot(self._clock())
+            slots = list(self._slots.values())
+        buckets = [sum(counts) for counts in zip(*[s[0] for s in slots])]
+        count = sum(s[1] for s in slots)
+        largest = max([s[3] for s in slots] or [0.0])
+
+        def percentile(pct):
+            if not count:
+                return None
+            rank = pct / 100.0 * count
+            seen = 0
+            for i, n in enumerate(buckets):
+                seen += n
+                if seen >= rank:
+                    return self.BOUNDS[i] if i < len(self.BOUNDS) else largest
+            return largest
+
+        return {
+            'count': count,
+            'total': sum(s[2] for s in slots),
+            'max': largest,
+            'p50': percentile(50),
+            'p95': percentile(95),
+            'p99': percentile(99),
+        }
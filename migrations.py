@@ -0,0 +1,68 @@
+"""Brings an existing database up to the schema declared in models.
+
+Only additive changes are made: missing tables, missing nullable columns
+and missing indexes. The unique index on submissions is skipped, with a
+report, while duplicate (user_id, prob_id) rows remain.
+"""
+
+import sqlalchemy
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.expression import func
+
+import models
+
+
+def _duplicates(conn, table, columns):
+    cols = [table.c[name] for name in columns]
+    # A unique index admits any number of rows with a NULL in its key.
+    query = sqlalchemy.select(cols + [func.count()]).where(
+            sqlalchemy.and_(*[col.isnot(None) for col in cols])).group_by(
+            *cols).having(func.count() > 1)
+    return conn.execute(query).fetchall()
+
+
+def add_missing_columns(engine):
+    """Add the nullable columns of models that existing tables lack."""
+    inspector = sqlalchemy.inspect(engine)
+    added = []
+    for table in models.Base.metadata.sorted_tables:
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            spec = CreateColumn(column).compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                        engine.dialect.identifier_preparer.format_table(table),
+                        spec))
+            print('added', '{}.{}'.format(table.name, column.name))
+            added.append('{}.{}'.format(table.name, column.name))
+    return added
+
+
+def add_missing_indexes(engine):
+    """Create missing tables, columns and indexes.
+
+    Returns the names of the created indexes.
+    """
+    models.Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    inspector = sqlalchemy.inspect(engine)
+    created = []
+    for table in models.Base.metadata.sorted_tables:
+        existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda ix: ix.name):
+            if index.name in existing:
+                continue
+            if index.unique:
+                with engine.connect() as conn:
+                    dups = _duplicates(
+                            conn, table, [c.name for c in index.columns])
+                if dups:
+                    print('skipping', index.name, '-', len(dups),
+                          'duplicated keys, e.g.', list(dups[0]))
+                    continue
+            index.create(engine)
+            print('created', index.name)
+            created.append(index.name)
+    return created
@@ -1,19 +1,52 @@
-from sqlalchemy import (Column, Integer, DateTime, String, ForeignKey, Text, Boolean)
+from sqlalchemy import (Column, Integer, DateTime, String, ForeignKey, Text, Boolean,
+                        Index)
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
 
+class Contest(Base):
+    """One contest, owning its candidates, their submissions and rounds."""
+
+    __tablename__ = 'contests'
+    uid = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(50), unique=True)
+    is_active = Column(Boolean, default=True)
+    rounds = relationship('ContestRound', backref=backref('contest'),
+                          order_by='ContestRound.position')
+
+
+class ContestRound(Base):
+    """One sitting of a contest, e.g. its second day; see contests.py."""
+
+    __tablename__ = 'contest_rounds'
+    uid = Column(Integer, primary_key=True, autoincrement=True)
+    contest_id = Column(Integer, ForeignKey(Contest.uid), index=True)
+    position = Column(Integer)
+    label = Column(String(50))
+    slug = Column(String(20), unique=True)
+    test_name = Column(String(20), unique=True)
+    first_prob_id = Column(Integer)
+    num_problems = Column(Integer)
+    duration_mins = Column(Integer)
+    problem_level = Column(String(20))
+
+
 class User(Base):
 
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_contest_email', 'contest_id', 'email'),
+    )
     uid = Column(Integer, primary_key=True, autoincrement=True)
+    contest_id = Column(Integer, ForeignKey(Contest.uid))
     nickname = Column(String(20))
-    email = Column(String(100))
-    access_uuid = Column(String(32))
+    email = Column(String(100), index=True)
+    access_uuid = Column(String(32), index=True)
     preferred_lang = Column(String(20))
     submissions = relationship('Submission', backref=backref('user'))
+    # Start times from before contests; now in round_starts.
     start_timestamp = Column(DateTime)
     day2_timestamp = Column(DateTime)
 
@@ -21,30 +54,51 @@ class User(Base):
 class Submission(Base):
 
     __tablename__ = 'submissions'
+    __table_args__ = (
+        Index('uq_submissions_user_prob', 'user_id', 'prob_id', unique=True),
+        Index('ix_submissions_prob_lang', 'prob_id', 'language',
+              mysql_length={'language': 20}),
+        Index('ix_submissions_contest_prob', 'contest_id', 'prob_id',
+              'language', mysql_length={'language': 20}),
+    )
     uid = Column(Integer, primary_key=True, autoincrement=True)
+    # The candidate's contest, copied here so reports need no join.
+    contest_id = Column(Integer, ForeignKey(Contest.uid))
     prob_id = Column(Integer)
     user_id = Column(Integer,  ForeignKey(User.uid))
     link = Column(Text)
     language = Column(Text)
     timestamp = Column(DateTime)
+    # The grading lease shared by all server processes; see assignment.py.
+    lease_grader = Column(String(50))
+    lease_expires = Column(DateTime)
     scores = relationship('Score', backref=backref('submission'))
     resolved_score = relationship('ResolvedScore', backref=backref('submission'))
+    summary = relationship('ScoreSummary', uselist=False,
+                           backref=backref('submission'))
+    preview = relationship('SubmissionPreview', uselist=False,
+                           backref=backref('submission'))
 
 
 class Score(Base):
 
     __tablename__ = 'scores'
     uid = Column(Integer, primary_key=True, autoincrement=True)
-    submission_id = Column(Integer,  ForeignKey(Submission.uid))
-    grader = Column(String(50))
+    submission_id = Column(Integer,  ForeignKey(Submission.uid), index=True)
+    grader = Column(String(50), index=True)
     timestamp = Column(DateTime)
     score = Column(Integer)
     comment = Column(Text)
+    # Set on scores stored from a score log, which replays by this id.
+    log_id = Column(String(32), index=True, unique=True)
 
 
 class ExamPaper(Base):
 
     __tablename__ = 'exams'
+    __table_args__ = (
+        Index('ix_exams_test_name_active', 'test_name', 'is_active'),
+    )
     uid = Column(Integer, primary_key=True, autoincrement=True)
     test_name = Column(String(20))
     language = Column(String(20))
@@ -60,3 +114,51 @@ class ResolvedScore(Base):
     score = Column(Integer)
     comment = Column(Text)
 
+
+
+class ScoreSummary(Base):
+    """Running aggregates of the scores of one submission.
+
+    The valid_* columns ignore scores of -1 (unable to grade).
+    """
+
+    __tablename__ = 'score_summaries'
+    submission_id = Column(Integer, ForeignKey(Submission.uid), primary_key=True)
+    num_scores = Column(Integer, default=0)
+    min_score = Column(Integer)
+    max_score = Column(Integer)
+    num_valid = Column(Integer, default=0)
+    min_valid = Column(Integer)
+    max_valid = Column(Integer)
+    resolved_score = Column(Integer)
+
+
+class SubmissionPreview(Base):
+    """Preview and metadata of the file a submission links to.
+
+    source_link is the link that was processed; a row whose source_link no
+    longer matches the submission is out of date. error is set while the
+    job is failing and retried after next_attempt.
+    """
+
+    __tablename__ = 'submission_previews'
+    submission_id = Column(Integer, ForeignKey(Submission.uid), primary_key=True)
+    source_link = Column(Text)
+    preview_link = Column(Text)
+    content_type = Column(String(100))
+    page_count = Column(Integer)
+    size = Column(Integer)
+    sha256 = Column(String(64))
+    attempts = Column(Integer, default=0)
+    next_attempt = Column(DateTime)
+    error = Column(Text)
+    updated = Column(DateTime)
+
+
+class RoundStart(Base):
+    """When a candidate opened the problems of a round."""
+
+    __tablename__ = 'round_starts'
+    user_id = Column(Integer, ForeignKey(User.uid), primary_key=True)
+    round_id = Column(Integer, ForeignKey(ContestRound.uid), primary_key=True)
+    started = Column(DateTime)
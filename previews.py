@@ -0,0 +1,236 @@
+"""Previews and metadata of submitted files, made off the request path.
+
+process() runs in a pool of worker processes: it hashes the file, counts
+its pages and writes a downscaled JPEG preview, content addressed like the
+uploads themselves. An image needs Pillow for a preview and a PDF needs
+poppler's pdftoppm; without them only the metadata is recorded.
+
+PreviewQueue keeps no queue of its own. Its loader asks the database which
+submissions lack an up-to-date preview, so the work left survives any
+restart, and a job is simply retried until record() stores a result. Only
+the process holding the flock on lock_path dispatches jobs.
+"""
+
+import concurrent.futures
+import fcntl
+import hashlib
+import io
+import mimetypes
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import uploads
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+CHUNK_SIZE = 64 * 1024
+PDF_PAGE = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+
+
+def _digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _pdf_pages(path):
+    count = 0
+    tail = b''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            data = tail + chunk
+            # Matches starting in the last bytes are counted next round,
+            # when the bytes after them are known.
+            cut = max(0, len(data) - 32)
+            count += sum(1 for m in PDF_PAGE.finditer(data) if m.start() < cut)
+            tail = data[cut:]
+    return count + len(PDF_PAGE.findall(tail))
+
+
+def _image_preview(path, max_px, quality):
+    if Image is None:
+        return None
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail((max_px, max_px))
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=quality, optimize=True)
+    out.seek(0)
+    return out
+
+
+def _pdf_preview(path, max_px, quality):
+    if shutil.which('pdftoppm') is None:
+        return None
+    workdir = tempfile.mkdtemp(prefix='preview-')
+    try:
+        subprocess.run(
+                ['pdftoppm', '-jpeg', '-jpegopt', 'quality={}'.format(quality),
+                 '-scale-to', str(max_px), '-f', '1', '-l', '1',
+                 '-singlefile', path, os.path.join(workdir, 'page')],
+                check=True, timeout=120, stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE)
+        with open(os.path.join(workdir, 'page.jpg'), 'rb') as f:
+            return io.BytesIO(f.read())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def process(path, out_root, max_px=1600, quality=70):
+    """Metadata of the file at path, and the blob name of its preview.
+
+    Safe to run again on the same file: the preview is content addressed.
+    """
+    content_type, _ = mimetypes.guess_type(path)
+    result = {
+        'content_type': content_type,
+        'size': os.path.getsize(path),
+        'sha256': _digest(path),
+        'page_count': None,
+        'preview': None,
+    }
+    preview = None
+    if content_type == 'application/pdf':
+        result['page_count'] = _pdf_pages(path)
+        preview = _pdf_preview(path, max_px, quality)
+    elif content_type and content_type.startswith('image/'):
+        result['page_count'] = 1
+        preview = _image_preview(path, max_px, quality)
+    if preview is not None:
+        os.makedirs(out_root, exist_ok=True)
+        result['preview'], _ = uploads.store_blob(preview, out_root, '.jpg')
+    return result
+
+
+class PreviewQueue(object):
+
+    def __init__(self, loader, record, out_root, lock_path, workers=2,
+                 poll_secs=2.0, max_px=1600):
+        # loader(limit) -> [(submission id, link, file path)] still to do
+        # record(submission id, link, result=None, error=None) stores a
+        # result or a failure; the loader decides when to retry failures
+        self._loader = loader
+        self._record = record
+        self._out_root = out_root
+        self._lock_path = lock_path
+        self._workers = workers
+        self._poll_secs = poll_secs
+        self._max_px = max_px
+        self._wake = threading.Event()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._lock_fd = None
+        self._pool = None
+        self._inflight = {}  # submission id -> (link, future)
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        """Start this process's dispatcher thread; safe to call again."""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if self._lock_fd is not None:
+                # Inherited over fork; the parent's lock.
+                os.close(self._lock_fd)
+                self._lock_fd = None
+            self._pool = None
+            self._inflight = {}
+        thread = threading.Thread(target=self._run, name='previews')
+        thread.daemon = True
+        thread.start()
+
+    def notify(self):
+        """Look for new work now instead of at the next poll.
+
+        Starts the dispatcher in this process if nothing did, e.g. under a
+        WSGI server that never calls start().
+        """
+        if self._pid != os.getpid():
+            self.start()
+        self._wake.set()
+
+    def _acquire_leadership(self):
+        directory = os.path.dirname(self._lock_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _dispatch(self):
+        if self._pool is None:
+            # Not forked: this process runs threads the children must not
+            # inherit.
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self._workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+        free = 2 * self._workers - len(self._inflight)
+        if free <= 0:
+            return
+        for sid, link, path in self._loader(free + len(self._inflight)):
+            if sid in self._inflight or free <= 0:
+                continue
+            future = self._pool.submit(
+                    process, path, self._out_root, self._max_px)
+            future.add_done_callback(lambda _: self._wake.set())
+            self._inflight[sid] = (link, future)
+            free -= 1
+
+    def _collect(self):
+        for sid, (link, future) in list(self._inflight.items()):
+            if not future.done():
+                continue
+            del self._inflight[sid]
+            try:
+                result = future.result()
+            except Exception as e:
+                if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                    self._pool = None
+                self.failed += 1
+                self._record(sid, link, error='{}: {}'.format(
+                        type(e).__name__, e))
+            else:
+                self.processed += 1
+                self._record(sid, link, result=result)
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            self._wake.wait(self._poll_secs)
+            self._wake.clear()
+            try:
+                if self._lock_fd is None and not self._acquire_leadership():
+                    continue
+                self._collect()
+                self._dispatch()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                time.sleep(self._poll_secs)
+
+    def stats(self):
+        return {
+            'dispatching': self._lock_fd is not None,
+            'in_flight': len(self._inflight),
+            'processed': self.processed,
+            'failed': self.failed,
+        }
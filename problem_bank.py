@@ -0,0 +1,107 @@
+"""Problem statements read from problems/<language>/<level>.txt.
+
+Statements in a file are separated by blank lines. Each one is rendered
+once into an HTML fragment: text escaped, lines kept, and the \\( \\) and $ $
+math left in place for MathJax on the page. Files are re-read only when
+their mtime or size changes, and that is checked at most every check_secs,
+so pages never touch the disk.
+"""
+
+from collections import namedtuple
+import html
+import os
+import threading
+import time
+
+import jinja2
+
+
+Problem = namedtuple('Problem', ['number', 'text', 'html'])
+
+
+def parse(text):
+    """Split a problem file into its statements."""
+    statements = []
+    lines = []
+    for line in text.splitlines() + ['']:
+        if line.strip():
+            lines.append(line.rstrip())
+        elif lines:
+            statements.append('\n'.join(lines))
+            lines = []
+    return statements
+
+
+def render(statement):
+    lines = [html.escape(line, quote=False) for line in statement.split('\n')]
+    return jinja2.Markup('<p>{}</p>'.format('<br />\n'.join(lines)))
+
+
+class ProblemBank(object):
+
+    def __init__(self, root, check_secs=5, clock=time.time):
+        self.root = root
+        self._check_secs = check_secs
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._files = {}  # (language, level) -> ((mtime_ns, size), problems)
+        self._checked_at = None
+        self.loads = 0
+        self._refresh()
+
+    def _paths(self):
+        try:
+            languages = sorted(os.listdir(self.root))
+        except OSError:
+            return
+        for language in languages:
+            directory = os.path.join(self.root, language)
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                level, ext = os.path.splitext(filename)
+                if ext == '.txt':
+                    yield (language, level), os.path.join(directory, filename)
+
+    def _refresh(self):
+        files = {}
+        for key, path in self._paths():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # removed meanwhile
+            version = (stat.st_mtime_ns, stat.st_size)
+            current = self._files.get(key)
+            if current is not None and current[0] == version:
+                files[key] = current
+                continue
+            with open(path, encoding='utf-8') as f:
+                statements = parse(f.read())
+            files[key] = (version, tuple(
+                    Problem(i + 1, text, render(text))
+                    for i, text in enumerate(statements)))
+            self.loads += 1
+        self._files = files
+        self._checked_at = self._clock()
+
+    def versioned(self, language, level):
+        """(version, problems) of (language, level); (None, ()) if unknown.
+
+        The version is the (mtime_ns, size) of the file problems came from.
+        """
+        if self._clock() - self._checked_at >= self._check_secs:
+            with self._lock:
+                if self._clock() - self._checked_at >= self._check_secs:
+                    self._refresh()
+        return self._files.get((language, level), (None, ()))
+
+    def problems(self, language, level):
+        """Problems of (language, level) in file order; () if unknown."""
+        return self.versioned(language, level)[1]
+
+    def stats(self):
+        return {
+            'files': sorted('/'.join(key) for key in self._files),
+            'problems': sum(len(p) for _, p in self._files.values()),
+            'loads': self.loads,
+        }
@@ -0,0 +1,241 @@
+"""Per-route request profiling for the bottle application.
+
+The WSGI middleware times each request, and SQLAlchemy cursor events count
+the queries it runs and the time spent in them. Jinja rendering and file
+I/O are reported by the code doing them through record_phase(). Results
+go into rolling per-route histograms. A request that runs the same
+statement n_plus_one times or more is flagged as a likely N+1 pattern.
+
+When dump_dir is set, a watchdog thread samples the stack of every request
+that runs longer than slow_secs and writes the collapsed stacks to a file
+once the request finishes.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+
+import jinja2
+from sqlalchemy import event
+
+import metrics
+
+
+class _Request(object):
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_secs = 0.0
+        self.phases = collections.defaultdict(float)
+        self.statements = collections.Counter()
+        self.stacks = collections.Counter()
+
+
+class _RouteStats(object):
+
+    def __init__(self, window_secs):
+        self.wall = metrics.RollingHistogram(window_secs)
+        self.sql = metrics.RollingHistogram(window_secs)
+        self.phases = collections.defaultdict(
+                lambda: metrics.RollingHistogram(window_secs))
+        self.queries = metrics.Summary()
+        self.n_plus_one = 0
+        self.n_plus_one_example = None
+
+    def snapshot(self):
+        return {
+            'wall_secs': self.wall.snapshot(),
+            'sql_secs': self.sql.snapshot(),
+            'queries': self.queries.snapshot(),
+            'n_plus_one': self.n_plus_one,
+            'n_plus_one_example': self.n_plus_one_example,
+            'phase_secs': {name: hist.snapshot()
+                           for name, hist in list(self.phases.items())},
+        }
+
+
+class Profiler(object):
+
+    def __init__(self, engine, n_plus_one=10, window_secs=300,
+                 slow_secs=2.0, dump_dir=None, sample_secs=0.005):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._window_secs = window_secs
+        self._n_plus_one = n_plus_one
+        self._slow_secs = slow_secs
+        self._dump_dir = dump_dir
+        self._sample_secs = sample_secs
+        self._active = {}  # thread ident -> _Request
+        self._watchdog = None
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def _current(self):
+        return getattr(self._local, 'request', None)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        # Kept on the statement's own context: after_cursor_execute never
+        # runs for a statement that raises, so nothing is left to clean up.
+        if context is not None:
+            context._profiling_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        started = getattr(context, '_profiling_started', None)
+        if started is None:
+            return  # run by the dialect itself, without a context
+        current = self._current()
+        if current is not None:
+            current.queries += 1
+            current.sql_secs += time.perf_counter() - started
+            current.statements[statement] += 1
+
+    def record_phase(self, name, seconds):
+        """Add time spent in name (e.g. render, io) to the current request."""
+        current = self._current()
+        if current is not None:
+            current.phases[name] += seconds
+
+    def template_class(self):
+        """A jinja2.Template subclass that reports its render time."""
+        profiler = self
+
+        class TimedTemplate(jinja2.Template):
+
+            def render(self, *args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return jinja2.Template.render(self, *args, **kwargs)
+                finally:
+                    profiler.record_phase(
+                            'render', time.perf_counter() - started)
+
+        return TimedTemplate
+
+    def _start(self):
+        current = self._local.request = _Request()
+        if self._dump_dir:
+            with self._lock:
+                self._active[threading.get_ident()] = current
+                if self._watchdog is None:
+                    self._watchdog = threading.Thread(
+                            target=self._sample_slow_requests, daemon=True)
+                    self._watchdog.start()
+        return current
+
+    def _finish(self, current, route):
+        self._local.request = None
+        wall = time.perf_counter() - current.started
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = _RouteStats(self._window_secs)
+        stats.wall.observe(wall)
+        stats.sql.observe(current.sql_secs)
+        stats.queries.observe(current.queries)
+        for name, seconds in current.phases.items():
+            stats.phases[name].observe(seconds)
+        if current.statements:
+            statement, times = current.statements.most_common(1)[0]
+            if times >= self._n_plus_one:
+                stats.n_plus_one += 1
+                stats.n_plus_one_example = {
+                    'statement': ' '.join(statement.split())[:500],
+                    'times': times,
+                }
+        if current.stacks:
+            self._dump(route, wall, current.stacks)
+
+    def _sample_slow_requests(self):
+        while True:
+            now = time.perf_counter()
+            with self._lock:
+                slow = [(ident, req) for ident, req in self._active.items()
+                        if now - req.started >= self._slow_secs]
+            if not slow:
+                time.sleep(min(self._slow_secs / 4, 0.1))
+                continue
+            frames = sys._current_frames()
+            for ident, req in slow:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = ';'.join(
+                            '{}:{}'.format(os.path.basename(f.filename), f.name)
+                            for f in traceback.extract_stack(frame))
+                    req.stacks[stack] += 1
+            time.sleep(self._sample_secs)
+
+    def _dump(self, route, wall, stacks):
+        os.makedirs(self._dump_dir, exist_ok=True)
+        name = '{}-{:.0f}ms-{}.txt'.format(
+                ''.join(c if c.isalnum() else '_' for c in route).strip('_'),
+                wall * 1000, int(time.time() * 1000))
+        with open(os.path.join(self._dump_dir, name), 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+    def middleware(self, app):
+        profiler = self
+
+        def profiled_app(environ, start_response):
+            current = profiler._start()
+
+            def finish():
+                route = environ.get('bottle.route')
+                profiler._finish(current, route.rule if route else 'unmatched')
+
+            try:
+                result = app(environ, start_response)
+            except BaseException:
+                finish()
+                raise
+            return on_close(environ, result, finish)
+
+        return profiled_app
+
+    def snapshot(self):
+        with self._lock:
+            routes = list(self._routes.items())
+        return {route: stats.snapshot() for route, stats in routes}
+
+
+def on_close(environ, result, finish):
+    """result of a WSGI app, made to call finish once it is closed.
+
+    A wsgi.file_wrapper body is returned as is, so that the server can still
+    use sendfile, and finish is called right away.
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if isinstance(file_wrapper, type) and isinstance(result, file_wrapper):
+        finish()
+        return result
+    return _ClosingIterator(result, finish)
+
+
+class _ClosingIterator(object):
+    """Passes a response body through and calls finish when it is closed."""
+
+    def __init__(self, result, finish):
+        self._result = result
+        self._finish = finish
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self._result)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._result, 'close'):
+                self._result.close()
+        finally:
+            self._finish()
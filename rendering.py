@@ -0,0 +1,68 @@
+"""Jinja2 environment setup and cached page fragments.
+
+In production mode templates are compiled once at startup, never checked
+for changes again, and their bytecode is shared between worker processes
+through an on-disk cache, so a fresh worker starts warm.
+"""
+
+import os
+import threading
+
+import jinja2
+from jinja2 import Environment, FileSystemLoader
+
+
+def make_environment(template_dir, production=False, cache_dir=None,
+                     template_class=None):
+    if not production:
+        env = Environment(loader=FileSystemLoader(template_dir))
+        if template_class is not None:
+            env.template_class = template_class
+        return env
+    bytecode_cache = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+    env = Environment(loader=FileSystemLoader(template_dir),
+                      auto_reload=False,
+                      cache_size=-1,
+                      bytecode_cache=bytecode_cache)
+    if template_class is not None:
+        env.template_class = template_class
+    precompile(env)
+    return env
+
+
+def precompile(env):
+    """Compile every template so no request pays for it."""
+    for name in env.list_templates(extensions=['html']):
+        env.get_template(name)
+
+
+class FragmentCache(object):
+    """Renders the parts of a page that are the same for every candidate.
+
+    A fragment is cached per template, locale and key. version stands for
+    the data it shows, such as a problem file's mtime; a fragment cached
+    for another version is rendered again and replaced. Fragments are kept
+    until the process exits when enabled; otherwise they are rendered on
+    every call so template edits show up right away.
+    """
+
+    def __init__(self, env, enabled=True):
+        self._env = env
+        self._enabled = enabled
+        self._lock = threading.Lock()
+        self._fragments = {}  # (name, locale, *key) -> (version, fragment)
+
+    def render(self, name, locale, key=(), version=None, **context):
+        cache_key = (name, locale) + tuple(key)
+        entry = self._fragments.get(cache_key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        fragment = jinja2.Markup(self._env.get_template(name).render(
+                lang=locale, **context))
+        if self._enabled:
+            with self._lock:
+                self._fragments[cache_key] = (version, fragment)
+        return fragment
@@ -0,0 +1,246 @@
+"""Read-only snapshot of the exam data for the admin reports.
+
+ReportSnapshot copies the tables the reports read (TABLES) into a separate
+SQLite file, with covering indexes for the report queries, so the admin
+views and exports run their joins there instead of on the live database.
+The source is read in one transaction, so the copy is consistent.
+
+A build writes a new file and renames it over the old one. Readers see
+one complete snapshot or the next, and every session opens the current
+file read-only. Nothing is rebuilt while nobody looks at the reports: a
+report that finds the snapshot refresh_secs old starts a rebuild in the
+background and is served from the old snapshot meanwhile. Only the process
+holding the flock on path + '.lock' builds, so workers never build twice.
+"""
+
+from contextlib import contextmanager
+import datetime
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from urllib.parse import quote
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import Column, Float, Integer, MetaData, Table
+from sqlalchemy.pool import NullPool
+
+import models
+
+
+# What the admin listings, the review page and the exports read.
+TABLES = [models.Base.metadata.tables[name] for name in (
+    'users', 'submissions', 'scores', 'resolved_scores', 'score_summaries')]
+
+# Covering indexes for the admin listings, the review page and the exports.
+INDEXES = [
+    'CREATE INDEX ix_report_submissions_user'
+    ' ON submissions (user_id, prob_id, language, uid)',
+    'CREATE INDEX ix_report_submissions_prob'
+    ' ON submissions (contest_id, prob_id, language, uid, user_id)',
+    'CREATE INDEX ix_report_scores_submission'
+    ' ON scores (submission_id, score, grader)',
+    'CREATE INDEX ix_report_scores_grader ON scores (grader, submission_id)',
+    'CREATE INDEX ix_report_summaries'
+    ' ON score_summaries (num_scores, submission_id)',
+]
+
+_info = Table('snapshot_info', MetaData(),
+              Column('taken_at', Float),  # unix time the copy started
+              Column('build_secs', Float),
+              Column('num_rows', Integer))
+
+
+class ReportSnapshot(object):
+
+    def __init__(self, source, path, refresh_secs=60, batch_size=5000,
+                 clock=time.time):
+        self._source = source
+        self.path = os.path.abspath(path)
+        self._refresh_secs = refresh_secs
+        self._batch_size = batch_size
+        self._clock = clock
+        self._engine = sqlalchemy.create_engine(
+                'sqlite://', creator=self._connect, poolclass=NullPool)
+        self._sessions = sqlalchemy.orm.sessionmaker(bind=self._engine)
+        self._lock = threading.Lock()
+        self._info = None  # ((st_ino, st_mtime_ns), info)
+        self._building = False  # a background rebuild is running here
+        self.builds = 0
+        self.failures = 0
+        self.last_error = None
+
+    def _connect(self):
+        uri = 'file:{}?mode=ro'.format(quote(self.path))
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def _read_info(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            cached = self._info
+        if cached is None or cached[0] != version:
+            with self._engine.connect() as conn:
+                row = conn.execute(_info.select()).first()
+            cached = (version, dict(row))
+            with self._lock:
+                self._info = cached
+        return cached[1]
+
+    def info(self, refresh_stale=False):
+        """taken_at, age_secs, build_secs and num_rows, or None if absent.
+
+        With refresh_stale, a missing or stale snapshot is rebuilt in the
+        background; building says whether that is under way.
+        """
+        info = self._read_info()
+        age_secs = info and max(0.0, self._clock() - info['taken_at'])
+        if refresh_stale and (info is None
+                              or age_secs >= self._refresh_secs):
+            self.refresh_later(self._clock() - self._refresh_secs)
+        if info is None:
+            return None
+        return {
+            'taken_at': datetime.datetime.utcfromtimestamp(info['taken_at']),
+            'age_secs': age_secs,
+            'build_secs': info['build_secs'],
+            'num_rows': info['num_rows'],
+            'building': self._building,
+        }
+
+    @contextmanager
+    def session(self):
+        session = self._sessions()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def _source_connection(self):
+        conn = self._source.connect()
+        if self._source.dialect.name in ('postgresql', 'mysql'):
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+        return conn
+
+    def build(self):
+        """Copy the live tables into a new snapshot and swap it in."""
+        started = time.perf_counter()
+        taken_at = self._clock()
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        target = sqlalchemy.create_engine(
+                'sqlite:///' + tmp_path, poolclass=NullPool)
+        num_rows = 0
+        try:
+            with target.connect() as out:
+                # Nothing to recover: a failed build is simply thrown away.
+                out.execute('PRAGMA journal_mode=OFF')
+                out.execute('PRAGMA synchronous=OFF')
+                with out.begin():
+                    models.Base.metadata.create_all(out, tables=TABLES)
+                    _info.create(out)
+                    with self._source_connection() as source, \
+                            source.begin():
+                        for table in TABLES:
+                            num_rows += self._copy(source, out, table)
+                    for statement in INDEXES:
+                        out.execute(statement)
+                    out.execute(_info.insert(), {
+                        'taken_at': taken_at,
+                        'build_secs': time.perf_counter() - started,
+                        'num_rows': num_rows,
+                    })
+                out.execute('ANALYZE')
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            target.dispose()
+        self.builds += 1
+        return num_rows
+
+    def _copy(self, source, out, table):
+        result = source.execution_options(stream_results=True).execute(
+                table.select())
+        copied = 0
+        while True:
+            rows = result.fetchmany(self._batch_size)
+            if not rows:
+                return copied
+            out.execute(table.insert(), [dict(row) for row in rows])
+            copied += len(rows)
+
+    def refresh(self, since=None, blocking=True):
+        """Rebuild unless a snapshot taken at or after since exists.
+
+        Returns whether this call rebuilt it. Without blocking, gives up
+        when another process is building.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking
+                                                 else fcntl.LOCK_NB))
+            except OSError:
+                return False
+            info = self._read_info()
+            if (info is not None and since is not None
+                    and info['taken_at'] >= since):
+                return False
+            try:
+                self.build()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = '{}: {}'.format(type(e).__name__, e)
+                raise
+            return True
+        finally:
+            os.close(fd)  # releases the flock
+
+    def refresh_later(self, since=None):
+        """refresh() in a background thread, unless one is running here.
+
+        Returns whether a thread was started.
+        """
+        with self._lock:
+            if self._building:
+                return False
+            self._building = True
+        thread = threading.Thread(target=self._refresh_in_background,
+                                  args=(since,), name='report-snapshot')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _refresh_in_background(self, since):
+        try:
+            self.refresh(since, blocking=False)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._building = False
+
+    def stats(self):
+        info = self.info()
+        return {
+            'path': self.path,
+            'taken_at': info and info['taken_at'].isoformat(),
+            'age_secs': info and round(info['age_secs'], 3),
+            'build_secs': info and round(info['build_secs'], 3),
+            'num_rows': info and info['num_rows'],
+            'building': self._building,
+            'builds': self.builds,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
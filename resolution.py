@@ -0,0 +1,292 @@
+"""Resolves the grades of a whole exam in one pass over its scores.
+
+The scores are loaded into two flat arrays sorted by submission and reduced
+to one column per aggregate: num_scores, num_valid, min, max and spread,
+where -1 ("unable to grade") is excluded from everything but num_scores.
+A rule set then decides every submission at once.
+
+A rule is (conditions, outcome). conditions maps a column to an inclusive
+(low, high) range, None meaning unbounded, and matches no submission whose
+column is empty; {} matches everything. The first matching rule decides a
+submission:
+
+    MIN, MAX  the lowest / highest valid score
+    MID       the midpoint of the two, rounded down
+    REVIEW    no grade, a person has to resolve it
+
+review_clause() makes the same decision in SQL from the running totals in
+models.ScoreSummary, so the review page can filter and page it there, and
+grade() makes it for a single summary. The grades written by write() go
+stale when a submission gets another score; drop_automatic() removes them.
+"""
+
+from array import array
+from collections import namedtuple
+
+import sqlalchemy
+from sqlalchemy import select
+
+import models
+
+
+MIN = 'min'
+MAX = 'max'
+MID = 'mid'
+REVIEW = 'review'
+
+# What the exports have always done: the lowest valid score.
+DEFAULT_RULES = [
+    ({'num_valid': (None, 0)}, REVIEW),  # every score is -1
+    ({}, MIN),
+]
+
+# The reconciliation the graders agreed on: two graders within a point
+# take the lower score, two points apart take the middle, anything else,
+# and any 7 that is not unanimous, goes to review.
+STRICT_RULES = [
+    ({'num_valid': (None, 0)}, REVIEW),
+    ({'num_scores': (None, 1)}, REVIEW),
+    ({'spread': (0, 0)}, MIN),
+    ({'max': (7, None)}, REVIEW),
+    ({'spread': (1, 1)}, MIN),
+    ({'spread': (2, 2)}, MID),
+    ({}, REVIEW),
+]
+
+COLUMNS = ('num_scores', 'num_valid', 'min', 'max', 'spread')
+
+# Grader name of the rows written by write(); other rows are resolutions
+# made by hand and are never overwritten.
+AUTO_GRADER = 'auto'
+
+Resolution = namedtuple(
+        'Resolution', ['columns', 'grades', 'rules', 'review'])
+
+
+def _contest_submissions(contest_id):
+    submissions = models.Submission.__table__
+    return select([submissions.c.uid]).where(
+            submissions.c.contest_id == contest_id)
+
+
+def load_scores(session, contest_id=None):
+    """(submission ids, scores) of every score as arrays, by submission.
+
+    With contest_id, only the scores of that contest's submissions.
+    """
+    table = models.Score.__table__
+    sids = array('l')
+    scores = array('l')
+    query = select([table.c.submission_id, table.c.score]).where(
+            table.c.score.isnot(None))
+    if contest_id is not None:
+        query = query.where(table.c.submission_id.in_(
+                _contest_submissions(contest_id)))
+    rows = session.execute(query.order_by(table.c.submission_id))
+    for sid, score in rows:
+        sids.append(sid)
+        scores.append(score)
+    return sids, scores
+
+
+def aggregate(sids, scores):
+    """Group sorted (sids, scores) into a dict of per-submission columns.
+
+    min, max and spread are None for a submission without valid scores.
+    """
+    columns = {'submission_id': array('l')}
+    for name in COLUMNS:
+        columns[name] = []
+    ids, nums, valids = columns['submission_id'], columns['num_scores'], \
+        columns['num_valid']
+    lows, highs = columns['min'], columns['max']
+    previous = None
+    for sid, score in zip(sids, scores):
+        if sid != previous:
+            ids.append(sid)
+            nums.append(0)
+            valids.append(0)
+            lows.append(None)
+            highs.append(None)
+            previous = sid
+        nums[-1] += 1
+        if score == -1:
+            continue
+        valids[-1] += 1
+        if lows[-1] is None or score < lows[-1]:
+            lows[-1] = score
+        if highs[-1] is None or score > highs[-1]:
+            highs[-1] = score
+    columns['spread'] = [None if lo is None else hi - lo
+                         for lo, hi in zip(lows, highs)]
+    return columns
+
+
+def _mask(columns, conditions, candidates):
+    """Indexes in candidates whose columns fall in every range."""
+    for name, (low, high) in conditions.items():
+        column = columns[name]
+        candidates = [i for i in candidates
+                      if column[i] is not None
+                      and (low is None or column[i] >= low)
+                      and (high is None or column[i] <= high)]
+    return candidates
+
+
+def apply_rules(columns, rules):
+    """Resolution of aggregated columns under rules.
+
+    grades[i] is the grade of columns['submission_id'][i] or None, rules[i]
+    the index of the rule that decided it (-1 if none did), and review the
+    ids of the submissions sent to review.
+    """
+    count = len(columns['submission_id'])
+    grades = [None] * count
+    decided_by = array('l', [-1]) * count
+    lows, highs = columns['min'], columns['max']
+    undecided = range(count)
+    for index, (conditions, outcome) in enumerate(rules):
+        matched = _mask(columns, conditions, undecided)
+        if not matched:
+            continue
+        for i in matched:
+            decided_by[i] = index
+        if outcome == MIN:
+            for i in matched:
+                grades[i] = lows[i]
+        elif outcome == MAX:
+            for i in matched:
+                grades[i] = highs[i]
+        elif outcome == MID:
+            for i in matched:
+                grades[i] = (lows[i] + highs[i]) // 2
+        elif outcome != REVIEW:
+            raise ValueError('unknown outcome {!r}'.format(outcome))
+        matched = set(matched)
+        undecided = [i for i in undecided if i not in matched]
+    ids = columns['submission_id']
+    review = [ids[i] for i in range(count)
+              if decided_by[i] != -1 and rules[decided_by[i]][1] == REVIEW]
+    return Resolution(columns, grades, decided_by, review)
+
+
+def _summary_columns(summary):
+    lo, hi = summary.min_valid, summary.max_valid
+    return {
+        'num_scores': [summary.num_scores],
+        'num_valid': [summary.num_valid],
+        'min': [lo],
+        'max': [hi],
+        'spread': [None if lo is None else hi - lo],
+    }
+
+
+def grade(summary, rules=DEFAULT_RULES):
+    """Grade of one models.ScoreSummary under rules, or None for review."""
+    if not summary.num_scores:
+        return None
+    columns = _summary_columns(summary)
+    for conditions, outcome in rules:
+        if not _mask(columns, conditions, [0]):
+            continue
+        if outcome == MIN:
+            return summary.min_valid
+        if outcome == MAX:
+            return summary.max_valid
+        if outcome == MID:
+            return (summary.min_valid + summary.max_valid) // 2
+        if outcome != REVIEW:
+            raise ValueError('unknown outcome {!r}'.format(outcome))
+        return None
+    return None
+
+
+def _clause(columns, conditions):
+    clauses = []
+    for name, (low, high) in conditions.items():
+        column = columns[name]
+        clauses.append(column.isnot(None))
+        if low is not None:
+            clauses.append(column >= low)
+        if high is not None:
+            clauses.append(column <= high)
+    return sqlalchemy.and_(sqlalchemy.true(), *clauses)
+
+
+def review_clause(rules=DEFAULT_RULES):
+    """SQL condition on ScoreSummary of the submissions sent to review.
+
+    Agrees with apply_rules as long as the summaries are up to date.
+    """
+    summary = models.ScoreSummary
+    columns = {
+        'num_scores': summary.num_scores,
+        'num_valid': summary.num_valid,
+        'min': summary.min_valid,
+        'max': summary.max_valid,
+        'spread': summary.max_valid - summary.min_valid,
+    }
+    review = []
+    earlier = []  # a submission goes to the first rule it matches
+    for conditions, outcome in rules:
+        clause = _clause(columns, conditions)
+        if outcome == REVIEW:
+            review.append(sqlalchemy.and_(clause, *[~c for c in earlier]))
+        earlier.append(clause)
+    if not review:
+        return sqlalchemy.false()
+    return sqlalchemy.and_(summary.num_scores > 0, sqlalchemy.or_(*review))
+
+
+def drop_automatic(session, submission_ids, grader=AUTO_GRADER):
+    """Remove the grades write() gave submission_ids, e.g. on a new score.
+
+    Grades resolved by hand stay.
+    """
+    submission_ids = list(set(submission_ids))
+    if not submission_ids:
+        return
+    table = models.ResolvedScore.__table__
+    summaries = models.ScoreSummary.__table__
+    automatic = select([table.c.uid]).where(
+            table.c.uid.in_(submission_ids)).where(table.c.grader == grader)
+    session.execute(summaries.update().where(
+            summaries.c.submission_id.in_(automatic)).values(
+                resolved_score=None))
+    session.execute(table.delete().where(
+            table.c.uid.in_(submission_ids)).where(table.c.grader == grader))
+
+
+def resolve(session, rules=DEFAULT_RULES, contest_id=None):
+    return apply_rules(aggregate(*load_scores(session, contest_id)), rules)
+
+
+def write(session, resolution, grader=AUTO_GRADER, contest_id=None):
+    """Replace the automatic ResolvedScore rows with resolution's grades.
+
+    Submissions resolved by hand keep their row. With contest_id, rows of
+    other contests are left alone. Returns the number of rows written.
+    """
+    table = models.ResolvedScore.__table__
+    summaries = models.ScoreSummary.__table__
+    delete = table.delete().where(table.c.grader == grader)
+    manual = select([table.c.uid])
+    update = summaries.update()
+    if contest_id is not None:
+        scope = _contest_submissions(contest_id)
+        delete = delete.where(table.c.uid.in_(scope))
+        manual = manual.where(table.c.uid.in_(scope))
+        update = update.where(summaries.c.submission_id.in_(scope))
+    session.execute(delete)
+    manual = {uid for uid, in session.execute(manual)}
+    ids = resolution.columns['submission_id']
+    rows = [{'uid': ids[i], 'grader': grader, 'score': grade,
+             'comment': 'rule {}'.format(resolution.rules[i])}
+            for i, grade in enumerate(resolution.grades)
+            if grade is not None and ids[i] not in manual]
+    if rows:
+        session.execute(table.insert(), rows)
+    session.execute(update.values(resolved_score=select(
+            [table.c.score]).where(
+                table.c.uid == summaries.c.submission_id).as_scalar()))
+    return len(rows)
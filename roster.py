@@ -0,0 +1,125 @@
+"""Bulk import and export of the candidate roster.
+
+Both directions stream their files and talk to the database one batch at a
+time: one IN lookup and one multi-row INSERT per batch on import, one IN
+lookup (or one server-side cursor) on export.
+"""
+
+import binascii
+import csv
+import itertools
+import os
+import time
+
+import models
+
+
+def batched(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if not batch:
+            return
+        yield batch
+
+
+def read_emails(f):
+    """Yield the emails of a roster file.
+
+    Accepts whitespace separated emails or a CSV whose first column is the
+    email; blank cells and duplicates are skipped.
+    """
+    seen = set()
+    for row in csv.reader(f):
+        if not row:
+            continue
+        for email in row[0].split():
+            if email not in seen:
+                seen.add(email)
+                yield email
+
+
+def new_access_tokens(count):
+    """Return count random 32 hex digit access ids from one urandom call."""
+    raw = binascii.hexlify(os.urandom(16 * count)).decode('ascii')
+    return [raw[i * 32:(i + 1) * 32] for i in range(count)]
+
+
+class Progress(object):
+
+    def __init__(self, verb):
+        self.verb = verb
+        self.rows = 0
+        self.started = time.time()
+
+    def add(self, rows, seen):
+        self.rows += rows
+        elapsed = time.time() - self.started
+        print('{} {} rows, {} read, {:.0f} rows/s'.format(
+            self.verb, self.rows, seen, seen / elapsed if elapsed > 0 else 0))
+
+
+def import_users(engine, emails, batch_size=1000, contest_id=None):
+    """Insert the emails that are not users of contest_id yet.
+
+    Returns rows inserted.
+    """
+    users = models.User.__table__
+    progress = Progress('inserted')
+    seen = 0
+    for batch in batched(emails, batch_size):
+        seen += len(batch)
+        with engine.begin() as conn:
+            existing = {email for email, in conn.execute(
+                    users.select().with_only_columns([users.c.email]).where(
+                        users.c.contest_id == contest_id).where(
+                        users.c.email.in_(batch)))}
+            new = [e for e in batch if e not in existing]
+            if new:
+                conn.execute(users.insert(), [
+                    {'email': email, 'access_uuid': token,
+                     'contest_id': contest_id}
+                    for email, token in zip(new, new_access_tokens(len(new)))
+                ])
+        progress.add(len(new), seen)
+    return progress.rows
+
+
+def export_users(engine, out, base_url, emails=None, batch_size=1000,
+                 contest_id=None):
+    """Write (email, access link) rows as CSV; returns rows written.
+
+    Only users in emails are exported when it is given, and only users of
+    contest_id when that is.
+    """
+    users = models.User.__table__
+    query = users.select().with_only_columns(
+            [users.c.email, users.c.access_uuid])
+    if contest_id is not None:
+        query = query.where(users.c.contest_id == contest_id)
+    writer = csv.writer(out)
+    progress = Progress('exported')
+    seen = 0
+
+    def write(rows):
+        rows = [(email, '{}/user/{}'.format(base_url, access))
+                for email, access in rows]
+        writer.writerows(rows)
+        return len(rows)
+
+    with engine.connect() as conn:
+        if emails is None:
+            result = conn.execution_options(stream_results=True).execute(
+                    query)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                seen += len(rows)
+                progress.add(write(rows), seen)
+        else:
+            for batch in batched(emails, batch_size):
+                seen += len(batch)
+                rows = conn.execute(query.where(users.c.email.in_(batch)))
+                progress.add(write(rows), seen)
+    return progress.rows
@@ -0,0 +1,226 @@
+"""Write-behind log for grader scores.
+
+append() makes a score durable with one fsync of a local append-only file
+and returns; a background thread swaps the file out every interval and hands
+the whole batch to writer(records), which stores it in one transaction.
+
+Each process writes its own scores-<pid>.wal and holds an exclusive flock on
+every log file it owns, so a file that nobody has locked belongs to a
+process that died; any live process replays it on its next tick. writer must
+be idempotent because a crash between its commit and the unlink of the batch
+file replays that batch again. append() gives every record a random log_id
+for that: two scores are never mistaken for one, even when they are alike
+down to the second.
+
+writer returns the records it refuses to store, e.g. scores of submissions
+deleted since; they go to scores.rejected in the same directory instead of
+blocking the log. A batch that fails is retried on the next tick, without
+holding up the batches after it.
+"""
+
+import datetime
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def encode(record):
+    record = dict(record)
+    record['timestamp'] = record['timestamp'].strftime(TIMESTAMP_FORMAT)
+    return (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+
+
+def decode(lines):
+    """Parse log lines, skipping a torn last write."""
+    records = []
+    for line in lines:
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            continue
+        record['timestamp'] = datetime.datetime.strptime(
+                record['timestamp'], TIMESTAMP_FORMAT)
+        if 'log_id' not in record:
+            # Written before log ids; the line itself is stable on replay.
+            record['log_id'] = hashlib.sha1(line).hexdigest()[:32]
+        records.append(record)
+    return records
+
+
+def _open_locked(path, flags):
+    fd = os.open(path, flags, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+class ScoreLog(object):
+
+    def __init__(self, directory, writer, interval_secs=1.0):
+        # writer(records) -> refused records, stores the rest of a batch;
+        # raises to retry the whole batch later
+        self.directory = directory
+        self._writer = writer
+        self._interval = interval_secs
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush() at a time
+        self._pid = None
+        self._fd = None
+        self._path = None
+        self._pending = []  # (path, fd) of batches not stored yet
+        self._seq = 0
+        self.appended = 0
+        self.stored = 0
+        self.batches = 0
+        self.replayed = 0
+        self.rejected = 0
+        self.failures = 0
+        self.last_batch_secs = 0.0
+
+    def start(self):
+        """Open this process's log and start flushing; safe to call again."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Forked after start(): the parent still owns its files.
+            for fd in [self._fd] + [fd for _, fd in self._pending]:
+                if fd is not None:
+                    os.close(fd)
+            self._pid = os.getpid()
+            self._pending = []
+            os.makedirs(self.directory, exist_ok=True)
+            self._open_log()
+        thread = threading.Thread(target=self._run, name='score-log')
+        thread.daemon = True
+        thread.start()
+
+    def _open_log(self):
+        self._path = os.path.join(
+                self.directory, 'scores-{}.wal'.format(self._pid))
+        self._fd = _open_locked(
+                self._path, os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        if self._fd is None:
+            raise RuntimeError('score log {} is locked'.format(self._path))
+
+    def append(self, record):
+        """Durably log one score; record needs a datetime 'timestamp'.
+
+        Returns the log_id given to the record.
+        """
+        if self._pid != os.getpid():
+            self.start()
+        record = dict(record, log_id=uuid.uuid4().hex)
+        data = encode(record)
+        with self._lock:
+            os.write(self._fd, data)
+            os.fsync(self._fd)
+            self.appended += 1
+        return record['log_id']
+
+    def _rotate(self):
+        with self._lock:
+            if os.fstat(self._fd).st_size == 0:
+                return
+            self._seq += 1
+            batch = '{}.{}.batch'.format(self._path[:-len('.wal')], self._seq)
+            # The lock belongs to the open file, so it survives the rename.
+            os.rename(self._path, batch)
+            self._pending.append((batch, self._fd))
+            self._open_log()
+
+    def _store(self, path, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        with os.fdopen(os.dup(fd), 'rb') as f:
+            records = decode(f)
+        started = time.time()
+        refused = self._writer(records) if records else None
+        if refused:
+            self._reject(refused)
+        os.unlink(path)
+        os.close(fd)
+        stored = len(records) - len(refused or ())
+        self.batches += 1
+        self.stored += stored
+        self.last_batch_secs = time.time() - started
+        return stored
+
+    def _reject(self, records):
+        path = os.path.join(self.directory, 'scores.rejected')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, b''.join(encode(r) for r in records))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.rejected += len(records)
+        print('score log rejected', len(records), 'records, see', path)
+
+    def _replay_orphans(self):
+        error = None
+        for path in glob.glob(os.path.join(self.directory, 'scores-*')):
+            fd = _open_locked(path, os.O_RDONLY)
+            if fd is None:
+                continue  # a live process owns it
+            if not os.path.exists(path):
+                os.close(fd)  # stored and unlinked by its owner meanwhile
+                continue
+            try:
+                self.replayed += self._store(path, fd)
+            except Exception as e:
+                os.close(fd)
+                error = error or e
+        return error
+
+    def flush(self):
+        """Store everything logged so far, orphaned logs included.
+
+        Raises the first error met, after trying every batch.
+        """
+        with self._flush_lock:
+            self._rotate()
+            error = None
+            failed = []
+            for path, fd in self._pending:
+                try:
+                    self._store(path, fd)
+                except Exception as e:
+                    failed.append((path, fd))
+                    error = error or e
+            self._pending = failed
+            error = self._replay_orphans() or error
+            if error is not None:
+                raise error
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self._interval)
+            try:
+                self.flush()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                self.failures += 1
+
+    def stats(self):
+        return {
+            'appended': self.appended,
+            'stored': self.stored,
+            'batches': self.batches,
+            'replayed': self.replayed,
+            'rejected': self.rejected,
+            'failures': self.failures,
+            'pending_batches': len(self._pending),
+            'last_batch_secs': round(self.last_batch_secs, 6),
+        }
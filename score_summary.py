@@ -0,0 +1,128 @@
+"""Keeps models.ScoreSummary in step with the scores of each submission.
+
+New scores are folded in with a single UPDATE. Deleting scores cannot be
+undone incrementally, so the affected submissions are recomputed instead.
+"""
+
+from sqlalchemy import case
+from sqlalchemy.sql.expression import func
+
+import models
+
+
+Summary = models.ScoreSummary
+
+
+def _lower(column, value):
+    return case([(column.is_(None) | (column > value), value)], else_=column)
+
+
+def _higher(column, value):
+    return case([(column.is_(None) | (column < value), value)], else_=column)
+
+
+def create(session, submission_id):
+    """Add the empty summary of a new submission."""
+    session.add(Summary(submission_id=submission_id,
+                        num_scores=0, num_valid=0))
+
+
+def record_score(session, submission_id, score):
+    """Fold one new score into the summary of its submission."""
+    changes = {
+        Summary.num_scores: Summary.num_scores + 1,
+        Summary.min_score: _lower(Summary.min_score, score),
+        Summary.max_score: _higher(Summary.max_score, score),
+    }
+    if score != -1:
+        changes.update({
+            Summary.num_valid: Summary.num_valid + 1,
+            Summary.min_valid: _lower(Summary.min_valid, score),
+            Summary.max_valid: _higher(Summary.max_valid, score),
+        })
+    updated = session.query(Summary).filter_by(
+            submission_id=submission_id).update(
+                    changes, synchronize_session=False)
+    if not updated:
+        # Submission uploaded before summaries existed.
+        refresh(session, [submission_id])
+
+
+def set_resolved(session, submission_id, score):
+    updated = session.query(Summary).filter_by(
+            submission_id=submission_id).update(
+                    {Summary.resolved_score: score},
+                    synchronize_session=False)
+    if not updated:
+        refresh(session, [submission_id])
+
+
+def _aggregates(session, submission_ids=None):
+    valid = models.Score.score != -1
+    query = session.query(
+            models.Score.submission_id,
+            func.count(models.Score.uid),
+            func.min(models.Score.score),
+            func.max(models.Score.score),
+            func.sum(case([(valid, 1)], else_=0)),
+            func.min(case([(valid, models.Score.score)])),
+            func.max(case([(valid, models.Score.score)]))).group_by(
+                    models.Score.submission_id)
+    if submission_ids is not None:
+        query = query.filter(models.Score.submission_id.in_(submission_ids))
+    return query
+
+
+def _resolved(session, submission_ids=None):
+    query = session.query(models.ResolvedScore.uid, models.ResolvedScore.score)
+    if submission_ids is not None:
+        query = query.filter(models.ResolvedScore.uid.in_(submission_ids))
+    return dict(query)
+
+
+def _summary(submission_id, row, resolved):
+    _, num, lo, hi, num_valid, lo_valid, hi_valid = row
+    return Summary(
+            submission_id=submission_id,
+            num_scores=num, min_score=lo, max_score=hi,
+            num_valid=num_valid or 0, min_valid=lo_valid, max_valid=hi_valid,
+            resolved_score=resolved)
+
+
+def refresh(session, submission_ids):
+    """Recompute the summaries of submission_ids from their scores."""
+    submission_ids = list(set(submission_ids))
+    if not submission_ids:
+        return
+    rows = {row[0]: row for row in _aggregates(session, submission_ids)}
+    resolved = _resolved(session, submission_ids)
+    for sid in submission_ids:
+        row = rows.get(sid, (sid, 0, None, None, 0, None, None))
+        session.merge(_summary(sid, row, resolved.get(sid)))
+
+
+def fill_missing(session, batch_size=1000):
+    """Add the summaries that submissions lack; returns how many.
+
+    Databases from before summaries have none, and the reports and exports
+    only see submissions that have one.
+    """
+    missing = [sid for sid, in session.query(models.Submission.uid).outerjoin(
+            Summary).filter(Summary.submission_id.is_(None))]
+    for start in range(0, len(missing), batch_size):
+        refresh(session, missing[start:start + batch_size])
+        session.flush()
+    return len(missing)
+
+
+def rebuild_all(session):
+    """Recompute every summary from scratch; returns the number written."""
+    session.query(Summary).delete(synchronize_session=False)
+    rows = {row[0]: row for row in _aggregates(session)}
+    resolved = _resolved(session)
+    count = 0
+    for (sid,) in session.query(models.Submission.uid):
+        row = rows.get(sid, (sid, 0, None, None, 0, None, None))
+        session.add(_summary(sid, row, resolved.get(sid)))
+        count += 1
+    return count
@@ -0,0 +1,218 @@
+"""Pre-forking HTTP server for production.
+
+The master process binds the listening socket, forks the workers and
+restarts any that die. Each worker serves the shared socket either with a
+thread per connection (threaded) or with gevent greenlets (async), so a slow
+upload never holds up other requests. SIGTERM or SIGINT stops the workers
+from accepting, lets in-flight requests finish for up to grace_secs and then
+exits.
+
+Restarts back off: each death within failure_window_secs of the previous
+ones doubles the wait before the restart, from restart_secs up to
+max_restart_secs. When more than max_failures workers die within the
+window, the server stops rather than crash-looping.
+"""
+
+from collections import deque
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from wsgiref.simple_server import (
+        ServerHandler, WSGIServer, WSGIRequestHandler)
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+class _SendfileHandler(ServerHandler):
+
+    def sendfile(self):
+        """Send a wsgi.file_wrapper body with os.sendfile when possible.
+
+        Sends Content-Length bytes from the file's current offset, so a
+        body positioned at the start of a range sends just that range.
+        """
+        try:
+            fd = self.result.filelike.fileno()
+        except (AttributeError, OSError, ValueError):
+            return False
+        length = self.headers.get('Content-Length')
+        if length is None or self.request_handler.command == 'HEAD':
+            return False
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+        left = int(length)
+        self.send_headers()
+        self._flush()
+        sock = self.request_handler.connection
+        while left > 0:
+            sent = os.sendfile(sock.fileno(), fd, offset, left)
+            if sent == 0:
+                break  # file shorter than announced
+            offset += sent
+            left -= sent
+        self.bytes_sent = int(length) - left
+        return True
+
+
+class _RequestHandler(WSGIRequestHandler):
+
+    def handle(self):
+        # WSGIRequestHandler.handle() with the sendfile handler.
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        handler = _SendfileHandler(
+                self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+                multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+
+    daemon_threads = False
+    block_on_close = True  # server_close() waits for in-flight requests
+
+
+def _threaded_worker(sock, app, grace_secs):
+    server = _ThreadingWSGIServer(
+            sock.getsockname(), _RequestHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    host, port = sock.getsockname()[:2]
+    server.server_name = socket.getfqdn(host)
+    server.server_port = port
+    server.setup_environ()
+    server.set_app(app)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    server.server_close()
+
+
+def _gevent_worker(sock, app, grace_secs):
+    import gevent
+    from gevent.pywsgi import WSGIServer as GeventWSGIServer
+
+    server = GeventWSGIServer(sock, app)
+
+    def stop():
+        server.stop(timeout=grace_secs)
+
+    gevent.signal_handler(signal.SIGTERM, stop)
+    gevent.signal_handler(signal.SIGINT, stop)
+    server.serve_forever()
+
+
+WORKERS = {
+    'threaded': _threaded_worker,
+    'async': _gevent_worker,
+}
+
+
+def serve(app, host, port, mode='threaded', workers=None, grace_secs=30,
+          after_fork=None, restart_secs=1, max_restart_secs=30,
+          max_failures=10, failure_window_secs=60):
+    """Run app until SIGTERM/SIGINT; after_fork() runs in every worker.
+
+    Raises SystemExit if it stops because workers keep dying.
+    """
+    run_worker = WORKERS[mode]
+    workers = workers or default_workers()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    children = set()
+    stopping = []
+    exits = deque()   # times of recent worker deaths
+    restarts = []     # times at which to replace a dead worker
+    failed = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                if after_fork is not None:
+                    after_fork()
+                run_worker(sock, app, grace_secs)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(time.time())
+            for pid in children:
+                _kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print('serving on http://{}:{}/ with {} {} workers'.format(
+        host, port, workers, mode))
+    sys.stdout.flush()
+    for _ in range(workers):
+        spawn()
+
+    while children or restarts:
+        pid, status = os.waitpid(-1, os.WNOHANG) if children else (0, 0)
+        now = time.time()
+        if pid == 0:
+            if stopping:
+                del restarts[:]
+                if now - stopping[0] > grace_secs:
+                    for child in children:
+                        _kill(child, signal.SIGKILL)
+            while restarts and restarts[0] <= now:
+                restarts.pop(0)
+                spawn()
+            time.sleep(0.2)
+            continue
+        children.discard(pid)
+        if stopping:
+            continue
+        exits.append(now)
+        while exits[0] < now - failure_window_secs:
+            exits.popleft()
+        if len(exits) > max_failures:
+            print('worker', pid, 'exited with', status, '-', len(exits),
+                  'workers died within', failure_window_secs,
+                  'seconds, giving up')
+            failed.append(now)
+            stop(None, None)
+            continue
+        delay = min(max_restart_secs, restart_secs * 2 ** (len(exits) - 1))
+        print('worker', pid, 'exited with', status,
+              '- restarting in {:g}s'.format(delay))
+        restarts.append(now + delay)
+        restarts.sort()
+    sock.close()
+    if failed:
+        raise SystemExit('workers keep dying; see the log above')
+
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError:
+        pass
@@ -0,0 +1,253 @@
+"""Serves static assets and submitted files with validators and ranges.
+
+Every response carries a strong ETag: the sha256 in the name of a content
+addressed blob, or a hash of the file computed once per (mtime, size) for
+anything else. Blobs never change, so they are sent as immutable for a
+year; other files are revalidated with If-None-Match each time.
+
+A text asset with a .br or .gz sibling written by precompress() is sent
+compressed to clients that accept it. Bodies are file objects, so a server
+with a wsgi.file_wrapper that supports sendfile() sends them zero-copy; a
+range goes through a reader that stops at its end.
+
+Submitted files come from candidates, so serve() can be given the types
+that may be shown inline (INLINE_UPLOAD_TYPES); anything else is sent as an
+application/octet-stream attachment, and nosniff keeps browsers from
+guessing otherwise. An uploaded page is never rendered on our origin.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+
+import bottle
+from bottle import request
+
+import uploads
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, no-cache'
+COMPRESSIBLE = ('.html', '.css', '.js', '.svg', '.json', '.txt', '.xml')
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]  # preferred first
+CHUNK_SIZE = 64 * 1024
+# No script can run in these; notably not text/html or image/svg+xml.
+INLINE_UPLOAD_TYPES = frozenset([
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'application/pdf'])
+
+
+class _RangeFile(object):
+    """Read at most length bytes of f from its current position."""
+
+    def __init__(self, f, length):
+        self._f = f
+        self._left = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._f.read(size)
+        self._left -= len(data)
+        return data
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def close(self):
+        self._f.close()
+
+
+_digests = {}  # path -> ((mtime_ns, size), sha256)
+_digests_lock = threading.Lock()
+
+
+def file_digest(path, stat):
+    """sha256 of the file at path, hashed again only when it changes."""
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _digests_lock:
+        entry = _digests.get(path)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    with _digests_lock:
+        _digests[path] = (key, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def _accepted_encodings():
+    accepted = set()
+    for item in request.environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _matches(header, etag):
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]  # weak comparison is fine for GET
+        if tag in ('*', etag):
+            return True
+    return False
+
+
+def _http_date(secs):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(secs))
+
+
+def serve(path, root, content_addressed=False, inline_types=None):
+    """HTTPResponse for root/path.
+
+    Answers If-None-Match, If-Modified-Since, Range/If-Range and HEAD.
+    With content_addressed, files named like uploads.blob_name() are
+    marked immutable. With inline_types, files of any other type are sent
+    as attachments of type application/octet-stream.
+    """
+    root = os.path.abspath(root) + os.sep
+    filename = os.path.abspath(os.path.join(root, path.strip('/\\')))
+    if not filename.startswith(root):
+        return bottle.HTTPError(403, 'Access denied.')
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return bottle.HTTPError(404, 'File does not exist.')
+    if not os.path.isfile(filename):
+        return bottle.HTTPError(404, 'File does not exist.')
+
+    digest = content_addressed and uploads.blob_digest(path.strip('/'))
+    headers = {
+        'Cache-Control': IMMUTABLE if digest else REVALIDATE,
+        'Accept-Ranges': 'bytes',
+        'Last-Modified': _http_date(stat.st_mtime),
+    }
+    if not digest:
+        digest = file_digest(filename, stat)
+
+    mimetype, encoding = mimetypes.guess_type(filename)
+    if inline_types is not None:
+        headers['X-Content-Type-Options'] = 'nosniff'
+        if encoding or mimetype not in inline_types:
+            headers['Content-Disposition'] = 'attachment'
+            mimetype, encoding = 'application/octet-stream', None
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    if mimetype:
+        if mimetype.startswith('text/') and 'charset' not in mimetype:
+            mimetype += '; charset=UTF-8'
+        headers['Content-Type'] = mimetype
+
+    etag = '"{}"'.format(digest)
+    ranges = request.environ.get('HTTP_RANGE')
+    if os.path.splitext(filename)[1].lower() in COMPRESSIBLE:
+        headers['Vary'] = 'Accept-Encoding'
+        accepted = _accepted_encodings()
+        for coding, suffix in ENCODINGS:
+            try:
+                variant = os.stat(filename + suffix)
+            except OSError:
+                continue
+            if coding in accepted and variant.st_mtime >= stat.st_mtime:
+                filename += suffix
+                stat = variant
+                etag = '"{}-{}"'.format(digest, coding)
+                headers['Content-Encoding'] = coding
+                ranges = None  # ranges of the identity body only
+                break
+    headers['ETag'] = etag
+
+    if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        not_modified = _matches(if_none_match, etag)
+    else:
+        since = bottle.parse_date(
+                request.environ.get('HTTP_IF_MODIFIED_SINCE', '').split(';')[0])
+        not_modified = since is not None and since >= int(stat.st_mtime)
+    if not_modified:
+        headers.pop('Content-Type', None)
+        return bottle.HTTPResponse(status=304, **headers)
+
+    if_range = request.environ.get('HTTP_IF_RANGE')
+    if ranges and if_range and if_range.strip() != etag:
+        ranges = None  # changed since the client's copy; send it all
+    size = stat.st_size
+    status = 200
+    offset, length = 0, size
+    if ranges:
+        parsed = list(bottle.parse_range_header(ranges, size))
+        if not parsed:
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return bottle.HTTPResponse(status=416, **headers)
+        offset, end = parsed[0]
+        length = end - offset
+        status = 206
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                offset, end - 1, size)
+    headers['Content-Length'] = str(length)
+
+    if request.method == 'HEAD':
+        return bottle.HTTPResponse('', status=status, **headers)
+    body = open(filename, 'rb')
+    if status == 206:
+        body.seek(offset)
+        body = _RangeFile(body, length)
+    return bottle.HTTPResponse(body, status=status, **headers)
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix=uploads.TEMP_PREFIX)
+    with os.fdopen(fd, 'wb') as out:
+        out.write(data)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def precompress(root, min_size=256):
+    """Write .gz (and .br, with brotli installed) next to text assets.
+
+    Variants that are up to date or would not be smaller are skipped.
+    Returns the number of files written.
+    """
+    compressors = [('.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        compressors.insert(0, ('.br', lambda data: brotli.compress(
+                data, quality=11)))
+    written = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.splitext(filename)[1].lower() not in COMPRESSIBLE:
+                continue
+            stat = os.stat(path)
+            if stat.st_size < min_size:
+                continue
+            data = None
+            for suffix, compress in compressors:
+                try:
+                    if os.stat(path + suffix).st_mtime >= stat.st_mtime:
+                        continue
+                except OSError:
+                    pass
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = compress(data)
+                if len(compressed) < len(data):
+                    _write_atomic(path + suffix, compressed)
+                    written += 1
+    return written
@@ -0,0 +1,50 @@
+"""Translated strings, one CSV column per locale.
+
+The first CSV row holds the locale codes and the second the language names.
+Only those two rows are read at startup; the strings of a locale are read
+into a tuple the first time the locale is used.
+"""
+
+import csv
+import threading
+
+
+class I18nManager(object):
+
+    def __init__(self, csv_path):
+        self._csv_path = csv_path
+        with open(csv_path) as f:
+            reader = csv.reader(f)
+            self.all_locales = next(reader)
+            names = next(reader)
+        self.locales_to_index = {
+                locale : i for i, locale in enumerate(self.all_locales)}
+        self.name_to_index = {
+                locale : i for i, locale in enumerate(names)}
+        self._columns = {}  # locale -> tuple of strings, row 1 first
+        self._lock = threading.Lock()
+
+    def _load(self, locale):
+        lpos = self.locales_to_index[locale]
+        with self._lock:
+            column = self._columns.get(locale)
+            if column is None:
+                with open(self._csv_path) as f:
+                    column = tuple(row[lpos] if lpos < len(row) else ''
+                                   for row in csv.reader(f))
+                self._columns[locale] = column
+        return column
+
+    def text(self, position, locale):
+        try:
+            return self._columns[locale][position - 1]
+        except KeyError:
+            return self._load(locale)[position - 1]
+
+    def lang_name(self, locale):
+        if locale == 'ee':
+            return 'Estonian'
+        return self.text(2, locale)
+
+    def locale_name(self, name):
+        return self.all_locales[self.name_to_index[name]]
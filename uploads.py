@@ -0,0 +1,153 @@
+"""Writes uploaded files to disk without holding a database session.
+
+The bytes are copied in fixed-size chunks into a temp file next to the
+destination, hashed on the way, fsynced and then renamed into place, so a
+reader never sees a half-written file.
+
+Submitted files are content addressed: a blob lives at
+ab/cd/<sha256><ext> under the save directory and is stored only once no
+matter how many submissions point at it.
+"""
+
+from collections import namedtuple
+import hashlib
+import os
+import tempfile
+import time
+
+import metrics
+
+
+CHUNK_SIZE = 64 * 1024
+
+StoredFile = namedtuple('StoredFile', ['path', 'size', 'sha256', 'seconds'])
+
+upload_bytes = metrics.Summary()
+upload_seconds = metrics.Summary()
+upload_throughput = metrics.Summary()  # bytes per second of each upload
+
+
+TEMP_PREFIX = '.upload-'
+
+
+def _spool(fileobj, directory, chunk_size):
+    """Copy fileobj into a fsynced temp file in directory.
+
+    Returns (temp path, size, sha256 hex digest).
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        os.chmod(tmp_path, 0o644)
+    except BaseException:
+        _unlink(tmp_path)
+        raise
+    return tmp_path, size, digest.hexdigest()
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _record(size, seconds):
+    upload_bytes.observe(size)
+    upload_seconds.observe(seconds)
+    if seconds > 0:
+        upload_throughput.observe(size / seconds)
+
+
+def blob_name(sha256, ext):
+    """Path of a blob relative to the store root."""
+    return os.path.join(sha256[:2], sha256[2:4], sha256 + ext.lower())
+
+
+def store_blob(fileobj, root, ext, chunk_size=CHUNK_SIZE):
+    """Store fileobj under root by content; returns (blob name, StoredFile).
+
+    An upload whose content is already stored only refreshes the mtime of
+    the existing blob, which keeps garbage collection off it.
+    """
+    started = time.time()
+    tmp_path, size, sha256 = _spool(fileobj, root, chunk_size)
+    name = blob_name(sha256, ext)
+    path = os.path.join(root, name)
+    try:
+        if os.path.exists(path):
+            _unlink(tmp_path)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        _unlink(tmp_path)
+        raise
+    seconds = time.time() - started
+    _record(size, seconds)
+    return name, StoredFile(path, size, sha256, seconds)
+
+
+def _is_blob(name):
+    sha256, _ = os.path.splitext(name)
+    return len(sha256) == 64 and all(c in '0123456789abcdef' for c in sha256)
+
+
+def blob_digest(name):
+    """sha256 of the blob at relative path name, or None if not a blob."""
+    parts = name.replace(os.sep, '/').split('/')
+    if len(parts) != 3 or not _is_blob(parts[2]):
+        return None
+    sha256 = os.path.splitext(parts[2])[0]
+    if parts[:2] != [sha256[:2], sha256[2:4]]:
+        return None
+    return sha256
+
+
+def collect_garbage(root, referenced, grace_secs=3600, dry_run=False):
+    """Delete blobs under root whose name is not in referenced.
+
+    Blobs and abandoned temp files younger than grace_secs are kept, since
+    an upload may not have committed its submission yet. Returns
+    (files removed, bytes freed).
+    """
+    cutoff = time.time() - grace_secs
+    removed = freed = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        depth = 0 if rel == '.' else rel.count(os.sep) + 1
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root)
+            if filename.startswith(TEMP_PREFIX):
+                pass
+            elif depth != 2 or not _is_blob(filename) or name in referenced:
+                continue
+            stat = os.stat(path)
+            if stat.st_mtime > cutoff:
+                continue
+            removed += 1
+            freed += stat.st_size
+            if not dry_run:
+                _unlink(path)
+    return removed, freed
+
+
+def stats():
+    return {
+        'bytes': upload_bytes.snapshot(),
+        'seconds': upload_seconds.snapshot(),
+        'bytes_per_sec': upload_throughput.snapshot(),
+    }